@@ -21,6 +21,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
+from exceptions import NoCardError, ProtocolError
+from utils import b2h, h2b
+
+
 class LinkBase(object):
 
 	def wait_for_card(self, timeout=None, newcardonly=False):
@@ -32,6 +38,41 @@ class LinkBase(object):
 		"""
 		pass
 
+	def watch_cards(self, callback, newcardonly=True, error=None):
+		"""watch_cards(callback): Calls callback(self) from a background
+		   thread each time a card is inserted, until the returned
+		   threading.Event is set
+
+		   callback    : called with the card reset and ready
+		   newcardonly : Should an already inserted card be ignored ?
+		   error       : called with self and the exception if waiting for
+		                 a card fails other than by a protocol error (ex. the
+		                 reader was unplugged). The watch stops then, and the
+		                 returned Event is set.
+		"""
+		stop = threading.Event()
+
+		def watch():
+			newonly = newcardonly
+			while not stop.is_set():
+				try:
+					self.wait_for_card(timeout=1, newcardonly=newonly)
+				except (NoCardError, ProtocolError):
+					continue
+				except Exception as e:
+					stop.set()
+					if error is not None:
+						error(self, e)
+					return
+				newonly = True
+				if not stop.is_set():
+					callback(self)
+
+		t = threading.Thread(target=watch)
+		t.daemon = True
+		t.start()
+		return stop
+
 	def connect(self):
 		"""connect(): Connect to a card immediately
 		"""
@@ -47,6 +88,11 @@ class LinkBase(object):
 		"""
 		pass
 
+	def _bytes_native(self):
+		"""Tells if the link implements send_apdu_raw_bytes itself, links
+		   only implementing the hex send_apdu_raw are converted"""
+		return type(self).send_apdu_raw_bytes is not LinkBase.send_apdu_raw_bytes
+
 	def send_apdu_raw(self, pdu):
 		"""send_apdu_raw(pdu): Sends an APDU with minimal processing
 
@@ -55,7 +101,25 @@ class LinkBase(object):
 		            data : string (in hex) of returned data (ex. "074F4EFFFF")
 		            sw   : string (in hex) of status word (ex. "9000")
 		"""
-		pass
+		if not self._bytes_native():
+			return
+		data, sw = self.send_apdu_raw_bytes(h2b(pdu))
+		if sw is None:
+			return None, None
+		return b2h(data), '%04x' % sw
+
+	def send_apdu_raw_bytes(self, pdu):
+		"""send_apdu_raw_bytes(pdu): Sends an APDU with minimal processing
+
+		   pdu    : bytes of the APDU (ex. b"\xa0\xa4\x00\x00\x02\x3f\x00")
+		   return : tuple(data, sw), where
+		            data : bytes of returned data
+		            sw   : status word as an int (ex. 0x9000)
+		"""
+		data, sw = self.send_apdu_raw(b2h(pdu))
+		if sw is None:
+			return None, None
+		return h2b(data or ''), int(sw, 16)
 
 	def send_apdu(self, pdu):
 		"""send_apdu(pdu): Sends an APDU and auto fetch response data
@@ -65,6 +129,12 @@ class LinkBase(object):
 		            data : string (in hex) of returned data (ex. "074F4EFFFF")
 		            sw   : string (in hex) of status word (ex. "9000")
 		"""
+		if self._bytes_native():
+			data, sw = self.send_apdu_bytes(h2b(pdu))
+			if sw is None:
+				return None, None
+			return b2h(data), '%04x' % sw
+
 		data, sw = self.send_apdu_raw(pdu)
 
 		if (sw is not None) and (sw[0:2] == '9f'):
@@ -73,6 +143,19 @@ class LinkBase(object):
 
 		return data, sw
 
+	def send_apdu_bytes(self, pdu):
+		"""send_apdu_bytes(pdu): Sends an APDU and auto fetch response data
+
+		   pdu    : bytes of the APDU
+		   return : tuple(data, sw) as for send_apdu_raw_bytes
+		"""
+		data, sw = self.send_apdu_raw_bytes(pdu)
+
+		if (sw is not None) and (sw >> 8 == 0x9f):
+			data, sw = self.send_apdu_raw_bytes(bytes((pdu[0], 0xc0, 0x00, 0x00, sw & 0xff)))
+
+		return data, sw
+
 	def send_apdu_checksw(self, pdu, sw="9000"):
 		"""send_apdu_checksw(pdu,sw): Sends an APDU and check returned SW
 
@@ -86,3 +169,16 @@ class LinkBase(object):
 		if sw.lower() != rv[1]:
 			raise RuntimeError("SW match failed ! Expected %s and got %s." % (sw.lower(), rv[1]))
 		return rv
+
+	def send_apdu_checksw_bytes(self, pdu, sw=0x9000):
+		"""send_apdu_checksw_bytes(pdu,sw): Sends an APDU and check returned SW
+
+		   pdu    : bytes of the APDU
+		   sw     : expected status word as an int
+		   return : tuple(data, sw) as for send_apdu_raw_bytes
+		"""
+		rv = self.send_apdu_bytes(pdu)
+		if sw != rv[1]:
+			raise RuntimeError("SW match failed ! Expected %04x and got %s." %
+				(sw, rv[1] if rv[1] is None else '%04x' % rv[1]))
+		return rv
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Processing of the cards inserted in several readers at once
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import queue
+import threading
+
+from commands import SimCardCommands
+from exceptions import NoCardError, ProtocolError
+from SimSerial import SerialSimLink
+from SMSMessage import SMSmessage, reassembleMessages
+from utils import decode_adn
+
+
+def iter_card(sc, pin=None):
+    """Reads a card piece by piece : CHV state, SIM info, each contact as
+    soon as it's read, then the SMS with concatenated ones put together.
+    CHV1 is verified with pin first if it's enabled, RuntimeError is raised
+    if pin is None then.
+
+       return : generator of tuple(section, dict), section being 'chv',
+                'info', 'contact' or 'sms'
+    """
+    chv1_enabled, chv1_tries, chv2_enabled, chv2_tries = sc.get_chv_info()
+    yield 'chv', {
+        'chv1_enabled': chv1_enabled, 'chv1_tries_left': chv1_tries,
+        'chv2_enabled': chv2_enabled, 'chv2_tries_left': chv2_tries,
+    }
+    if chv1_enabled:
+        if pin is None:
+            raise RuntimeError('CHV1 is enabled, a PIN is needed')
+        sc.verify_chv(1, pin)
+
+    location, msisdn, imsi, iccid, phase = sc.get_sim_info()
+    yield 'info', {
+        'location': location, 'msisdn': msisdn, 'imsi': imsi,
+        'iccid': iccid, 'phase': phase,
+    }
+
+    for record in sc.get_adn():
+        adn = decode_adn(record)
+        if adn:
+            yield 'contact', {'name': adn[0], 'number': adn[1]}
+
+    # Concatenated messages can only be put together once all are read
+    messages = []
+    for rec_no, data, sw in sc.iter_sms(sparse=True, raw=True):
+        s = SMSmessage()
+        s.smsFromData(data)
+        if s.message:
+            messages.append((rec_no, s))
+
+    for s, segments, missing in reassembleMessages(messages):
+        sms = {
+            'record': segments[0][0],
+            'status': s.status,
+            'number': s.number,
+            'smsc': s.smsc,
+            'timestamp': s.timestamp,
+            'time': s.time,
+            'message': s.message,
+        }
+        if len(segments) > 1 or missing:
+            sms['records'] = [rec_no for rec_no, m in segments]
+            sms['missing'] = missing
+        yield 'sms', sms
+
+
+def read_card(sc, pin=None):
+    """Dumps a card, see iter_card
+
+       return : dict with 'chv', 'info', 'contacts' and 'sms'
+    """
+    rv = {'contacts': [], 'sms': []}
+    for section, item in iter_card(sc, pin):
+        if section == 'contact':
+            rv['contacts'].append(item)
+        elif section == 'sms':
+            rv['sms'].append(item)
+        else:
+            rv[section] = item
+    return rv
+
+
+def serial_link(port, baudrate=9600):
+    """Default link factory of ReaderPool"""
+    sl = SerialSimLink()
+    sl.connect(port, baudrate)
+    return sl
+
+
+class ReaderPool(object):
+    """Runs a job on every card inserted in any of several readers, each
+    reader being served by its own thread.
+
+       job          : callable(SimCardCommands, *args) run on each card
+       args         : extra arguments of job
+       ports        : readers to use, default is all the serial ports found
+       link_factory : callable(port) returning a connected LinkBase
+
+    Results are put on the results queue as tuple(port, result, error), with
+    error the exception raised by the job (or while opening the reader) and
+    result None then. Every card already inserted when the pool starts is
+    processed, then each newly inserted one. A reader failing while waiting
+    for a card (ex. unplugged) has its error put on the queue and is no
+    longer served.
+
+        pool = ReaderPool(read_card, ('1234',))
+        pool.start()
+        while True:
+            port, result, error = pool.results.get()
+    """
+
+    def __init__(self, job=read_card, args=(), ports=None, link_factory=serial_link):
+        self._job = job
+        self._args = args
+        self._link_factory = link_factory
+        self.ports = ports
+        self.results = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        if self.ports is None:
+            self.ports = SerialSimLink().scan_serial_ports()
+        self._stop.clear()
+        for port in self.ports:
+            t = threading.Thread(target=self._serve, args=(port,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self.ports
+
+    def stop(self, timeout=None):
+        """Stops waiting for cards, the jobs running are completed"""
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _serve(self, port):
+        try:
+            link = self._link_factory(port)
+        except Exception as e:
+            self.results.put((port, None, e))
+            return
+
+        newcardonly = False
+        try:
+            while not self._stop.is_set():
+                try:
+                    link.wait_for_card(timeout=1, newcardonly=newcardonly)
+                except (NoCardError, ProtocolError):
+                    continue
+                except Exception as e:
+                    # ex. the reader was unplugged, this port is done
+                    self.results.put((port, None, e))
+                    return
+                newcardonly = True
+                try:
+                    rv = self._job(SimCardCommands(link), *self._args)
+                except Exception as e:
+                    self.results.put((port, None, e))
+                else:
+                    self.results.put((port, rv, None))
+        finally:
+            try:
+                link.disconnect()
+            except Exception:
+                pass
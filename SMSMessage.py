@@ -18,8 +18,9 @@
 #                            I M P O R T S
 # ===============================================================================
 
-from binascii import hexlify, unhexlify
-import time, calendar
+from binascii import unhexlify
+import copy
+import time
 from utils import *
 
 
@@ -27,28 +28,140 @@ STATUS_READ     = 0
 STATUS_UNREAD   = 1
 STATUS_DELETED  = 2
 
+# Size of the EF_SMS records
+SMS_RECORD_SIZE = 176
+
+# Marks a field still to be decoded from the PDU
+_PENDING = object()
+
+_NO_TIME = (0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+# Fields of the TPDU header, all decoded at once
+_HEADER_FIELDS = ('mti', 'mms', 'sri', 'udhi', 'rp', 'pid', 'dcs', 'udl')
+_HEADER_SLOTS = tuple('_' + f for f in _HEADER_FIELDS)
+
+
+def _lazy(name, decode=None):
+    """Property of a field decoded from the PDU on first access, by decode
+    or else along with the whole header"""
+    slot = '_' + name
+
+    def get(self):
+        value = getattr(self, slot)
+        if value is _PENDING:
+            if decode is None:
+                self._parseLayout()
+                return getattr(self, slot)
+            value = decode(self)
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    return property(get, set)
+
+
+# Value of each byte of semi-octets, the low nibble holding the tens
+_SEMI_OCTETS = bytes((b & 0x0f) * 10 + (b >> 4) for b in range(256))
+
+_DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+_DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _epochDays(year, month, day):
+    """Days from 1970-01-01 to a date"""
+    days = (year - 1970) * 365 + (year - 1) // 4 - (year - 1) // 100 + (year - 1) // 400 - 477
+    days += _DAYS_BEFORE_MONTH[month] + day - 1
+    if month > 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        days += 1
+    return days
+
+
+def decodeTimestamp(scts):
+    """Decodes the 7 bytes of a TP-SCTS (TS 23.040 section 9.2.3.11)
+
+       return : tuple(time, timezone), time being the UTC epoch in seconds
+                or None if the SCTS isn't a valid date, timezone the offset
+                of the SMSC local time in quarters of an hour
+    """
+    year, month, day, hour, minute, second = scts[:6].translate(_SEMI_OCTETS)
+    tz = _SEMI_OCTETS[scts[6] & 0xf7]
+    if scts[6] & 0x08:
+        tz = -tz
+
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60 and second < 60):
+        return None, tz
+
+    # Hopefully no one uses this after 2079 ;)
+    year += 1900 if year >= 80 else 2000
+    days = _epochDays(year, month, day)
+    return days * 86400 + hour * 3600 + minute * 60 + second - tz * 900, tz
+
+
+def formatTimestamp(t, timezone=0):
+    """Formats the time from decodeTimestamp as the SMSC local time, ex.
+    Mon May 01 07:43:41 2002, '' if t is None"""
+    if t is None:
+        return ''
+    tm = time.gmtime(t + timezone * 900)
+    return "%s %s %02d %02d:%02d:%02d %d" % (_DAY_NAMES[tm[6]], _MONTH_NAMES[tm[1] - 1], tm[2],
+                                             tm[3], tm[4], tm[5], tm[0])
+
+
+def _statusText(val):
+    if not (val & 0x1):
+        return "Deleted"
+    elif not (val & 0x4):
+        if not (val & 0x2):
+            return "Read"
+        else:
+            return "Unread"
+    elif (val & 0x7) == 0x7:
+        return "To be sent"
+    else:
+        return "Unknown"
+
+
 class SMSmessage:
     # SMS Deliver and SMS Submit
     # 0107911614910900F5040B911614836816F1 0000 2050107034146B
     # 4C    FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+    #
+    # smsFromData only keeps the record, each field is decoded the first
+    # time it's read.
+    #
+    # The SCTS is kept as time, the UTC epoch, and timezone, in quarters of
+    # an hour. timestamp is only formatted when read.
+    __slots__ = ('_raw', '_layout') + tuple('_' + f for f in
+        ('status', 'smsc', 'number', 'time', 'timezone', 'timestamp', 'timetuple', 'message', 'udh',
+         'rawMessage') + _HEADER_FIELDS)
+
     def __init__(self):
-        self.status = 'Read'
-        self.smsc = ''
-        self.number = ''
-        self.timestamp = ''
-        self.timetuple = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.message = ''
-
-        self.mti = 0
-        self.mms = 0
-        self.sri = 0
-        self.udhi = 0
-        self.rp = 1
-        self.pid = 0
-        self.dcs = 0
-        self.udl = 0
-
-        self.rawMessage = ''
+        # Slots are set directly, the properties only add the decoding
+        self._raw = None
+        self._layout = None
+        self._status = 'Read'
+        self._smsc = ''
+        self._number = ''
+        self._time = None
+        self._timezone = 0
+        self._timestamp = ''
+        self._timetuple = _NO_TIME
+        self._message = ''
+
+        self._mti = 0
+        self._mms = 0
+        self._sri = 0
+        self._udhi = 0
+        self._rp = 1
+        self._pid = 0
+        self._dcs = 0
+        self._udl = 0
+        self._udh = b''
+
+        self._rawMessage = ''
 
     def clone(self):
         s = SMSmessage()
@@ -58,17 +171,7 @@ class SMSmessage:
         return s
 
     def setStatus(self, val):
-        if not (val & 0x1):
-            self.status = "Deleted"
-        elif not (val & 0x4):
-            if not (val & 0x2):
-                self.status = "Read"
-            else:
-                self.status = "Unread"
-        elif (val & 0x7) == 0x7:
-            self.status = "To be sent"
-        else:
-            self.status = "Unknown"
+        self.status = _statusText(val)
 
     def changeStatus(self, val=STATUS_READ):
         if val == STATUS_DELETED:
@@ -83,48 +186,150 @@ class SMSmessage:
             self.rawMessage = "0%d%s" % (i, self.rawMessage[2:])
 
     def smsFromData(self, data):
-        self.rawMessage = data
+        # data is the EF_SMS record, in hex or as bytes / memoryview
+        if isinstance(data, str):
+            self._rawMessage = data
+            data = unhexlify(data)
+        else:
+            data = bytes(data)
+            self._rawMessage = _PENDING
 
-        if data[:2] == "00":
+        self._raw = data
+        self._layout = None
+        if not data or data[0] == 0x00:
             self.message = ''
             return
 
-        self.setStatus(int(data[0:2], 16))
-
-        i = int(data[2:4], 16) << 1
-        self.smsc = GSMPhoneNumberToString(data[4:4 + i], replaceTonNPI=1)
-        data = data[4 + i:]
-
-        val = int(data[0:2], 16)
-        self.mti = (val >> 6) & 3
-        self.mms = (val >> 5) & 1
-        self.sri = (val >> 4) & 1
-        self.udhi = (val >> 3) & 1
-        self.rp = (val >> 2) & 1
-        data = data[2:]
-
-        i = int(data[:2], 16)
-        j = 4 + i + (i % 2)
-        self.number = GSMPhoneNumberToString(data[2:j], replaceTonNPI=1)
-        data = data[j:]
-
-        self.pid = int(data[:2], 16)
-        self.dcs = int(data[2:4], 16)
-
-        self.timestamp = self.convertTimestamp(data[4:18])
-
-        self.udl = int(data[18:20], 16)  # it's meaning is dependant upon dcs value
-        if ((self.dcs >> 2) & 3) == 0:  # 7-bit, Default alphabet
-            i = ((self.udl * 7) // 8) << 1
-            if (self.udl * 7) % 8:
-                i += 2
-            self.message = self.convertGSM7bitToAscii(data[20:20 + i])
-        elif ((self.dcs >> 2) & 3) == 1:  # 8-bit data, binary
-            self.message = "ERROR: Don't understand 8-bit binary messages"
-        elif ((self.dcs >> 2) & 3) == 2:  # 16-bit, UCS2 oh hell!  :)
-            self.message = "ERROR: Don't understand 16-bit UCS2 messages"
+        self._status = self._smsc = self._number = self._message = self._udh = _PENDING
+        self._time = self._timezone = self._timestamp = self._timetuple = _PENDING
+        self._mti = self._mms = self._sri = self._udhi = self._rp = self._pid = self._dcs = self._udl = _PENDING
+
+    def _parseLayout(self):
+        """Decodes the fixed part of the TPDU : the header fields still
+        pending (see _HEADER_FIELDS) are set, and the offsets of the SMSC,
+        the originating address, the SCTS and the user data returned"""
+        if self._layout is None:
+            data = self._raw
+            smsc = 2 + data[1]
+
+            # First octet of the TPDU (TS 23.040 section 9.2.2.1)
+            val = data[smsc]
+
+            # Address length is in digits, plus the TON/NPI byte
+            number = smsc + 2 + 1 + (data[smsc + 1] + 1) // 2
+
+            header = (val & 3, (val >> 2) & 1, (val >> 5) & 1, (val >> 6) & 1, (val >> 7) & 1,
+                      data[number], data[number + 1], data[number + 9])
+            for slot, value in zip(_HEADER_SLOTS, header):
+                if getattr(self, slot) is _PENDING:
+                    setattr(self, slot, value)
+            self._layout = (smsc, number, number + 2, number + 10)
+        return self._layout
+
+    def _decodeSmsc(self):
+        return GSMPhoneNumberToString(b2h(self._raw[2:self._parseLayout()[0]]), replaceTonNPI=1)
+
+    def _decodeNumber(self):
+        layout = self._parseLayout()
+        return GSMPhoneNumberToString(b2h(self._raw[layout[0] + 2:layout[1]]), replaceTonNPI=1)
+
+    def _scts(self):
+        pos = self._parseLayout()[2]
+        return self._raw[pos:pos + 7]
+
+    def _decodeTime(self):
+        t, tz = decodeTimestamp(self._scts())
+        if self._timezone is _PENDING:
+            self._timezone = tz
+        return t
+
+    def _decodeTimetuple(self):
+        t = self.time
+        if t is None:
+            return _NO_TIME
+        return time.gmtime(t + self.timezone * 900)
+
+    def _userData(self):
+        """Returns the user data and the length of its header"""
+        ud = memoryview(self._raw)[self._parseLayout()[3]:]
+        return ud, (ud[0] + 1 if self.udhi and ud else 0)
+
+    def _decodeUdh(self):
+        ud, udh_len = self._userData()
+        return bytes(ud[1:udh_len])
+
+    def _decodeMessage(self):
+        ud, udh_len = self._userData()
+
+        # The user data header, if any, is skipped. Septets are counted
+        # from the start of the UD, with the text starting on the septet
+        # boundary following the header.
+        alphabet = self.alphabet()
+        if alphabet == 0:  # 7-bit, Default alphabet
+            i = (self.udl * 7 + 7) // 8
+            skip = (udh_len * 8 + 6) // 7
+            return decode_gsm_3_38(unpack_septets(ud[:i], self.udl)[skip:])
+        elif alphabet == 1:  # 8-bit data, shown as latin-1
+            return bytes(ud[udh_len:self.udl]).decode('latin-1')
+        elif alphabet == 2:  # 16-bit, UCS2
+            text = ud[udh_len:self.udl]
+            return bytes(text[:len(text) & ~1]).decode('utf-16-be', 'replace')
         else:
-            self.message = "ERROR: Don't understand this message format"
+            return "ERROR: Don't understand this message format"
+
+    status = _lazy('status', lambda self: _statusText(self._raw[0]))
+    smsc = _lazy('smsc', _decodeSmsc)
+    number = _lazy('number', _decodeNumber)
+    time = _lazy('time', _decodeTime)
+    timezone = _lazy('timezone', lambda self: decodeTimestamp(self._scts())[1])
+    timestamp = _lazy('timestamp', lambda self: formatTimestamp(self.time, self.timezone))
+    timetuple = _lazy('timetuple', _decodeTimetuple)
+    message = _lazy('message', _decodeMessage)
+    udh = _lazy('udh', _decodeUdh)
+    rawMessage = _lazy('rawMessage', lambda self: b2h(self._raw))
+
+    mti = _lazy('mti')
+    mms = _lazy('mms')
+    sri = _lazy('sri')
+    udhi = _lazy('udhi')
+    rp = _lazy('rp')
+    pid = _lazy('pid')
+    dcs = _lazy('dcs')
+    udl = _lazy('udl')
+
+    def alphabet(self):
+        """Character set of the message according to the DCS (TS 23.038
+        section 4) : 0 for the GSM 7-bit default alphabet, 1 for 8-bit
+        data, 2 for UCS2, None for compressed or reserved codings"""
+        group = self.dcs >> 4
+        if group < 0x8:  # General data coding
+            if self.dcs & 0x20:
+                return None
+            alphabet = (self.dcs >> 2) & 3
+            return alphabet if alphabet < 3 else None
+        if group in (0xc, 0xd):  # Message waiting, discard / store
+            return 0
+        if group == 0xe:  # Message waiting, store UCS2
+            return 2
+        if group == 0xf:  # Data coding / message class
+            return (self.dcs >> 2) & 1
+        return None
+
+    def concatInfo(self):
+        """Concatenation information element of the user data header (TS
+        23.040 section 9.2.3.24.1 and .8) as tuple(reference, total,
+        sequence), None if the message isn't a segment"""
+        udh = self.udh
+        i = 0
+        while i + 1 < len(udh):
+            iei, length = udh[i], udh[i + 1]
+            ie = udh[i + 2:i + 2 + length]
+            if iei == 0x00 and length == 3:  # 8-bit reference
+                return ie[0], ie[1], ie[2]
+            if iei == 0x08 and length == 4:  # 16-bit reference
+                return (ie[0] << 8) | ie[1], ie[2], ie[3]
+            i += 2 + length
+        return None
 
     def smsToData(self, date, number, smsc, message):
         # 0107911614910900F504 0B911614836816F1 0000 2050107034146B
@@ -156,80 +361,31 @@ class SMSmessage:
         # add timestamp
         data += self.convertDateToTimestamp(date)
 
-        # add UDL
-        data += padFrontOfString(hex(len(message))[2:], 2)
+        # add UDL, in septets as escaped characters take two
+        septets = encode_gsm_3_38(message)
+        data += padFrontOfString(hex(len(septets))[2:], 2)
 
         # add the message (encoded in 7-bit GSM)
-        self.rawMessage = data + self.convertAsciiToGSM7bit(message)
+        self.rawMessage = data + b2h(pack_septets(septets))
 
-    def convertGSM7bitToAscii(self, data):
-        i = 0
-        mask = 0x7F
-        last = 0
-        res = []
-        for c in unhexlify(data):
-            # baaaaaaa ccbbbbbb dddccccc eeeedddd fffffeee ggggggff hhhhhhhg 0iiiiiii
-            # 0aaaaaaa 0bbbbbbb 0ccccccc 0ddddddd 0eeeeeee 0fffffff 0ggggggg 0hhhhhhh 0iiiiiii
-            val = ((c & mask) << i) + (last >> (8 - i))
-            res.append(chr(val))
-
-            i += 1
-            mask >>= 1
-            last = c
-            if i % 7 == 0:
-                res.append(chr(last >> 1))
-                i = 0
-                mask = 0x7F
-                last = 0
-        return GSM3_38ToASCII(''.join(res))
+    def convertGSM7bitToAscii(self, data, septets=None):
+        # data is the packed user data, in hex or bytes, septets the number
+        # of characters it holds (the UDL), default is as many as fit
+        if isinstance(data, str):
+            data = unhexlify(data)
+        return decode_gsm_3_38(unpack_septets(data, septets))
 
     def convertAsciiToGSM7bit(self, data):
-        i = 0
-        l = 0
-        mask = 0x0
-        data = ASCIIToGSM3_38(data)
-        res = []
-
-        while l < len(data):
-            # 0aaaaaaa 0bbbbbbb 0ccccccc 0ddddddd 0eeeeeee 0fffffff 0ggggggg 0hhhhhhh 0iiiiiii
-            # baaaaaaa ccbbbbbb dddccccc eeeedddd fffffeee ggggggff hhhhhhhg 0iiiiiii
-            c = ord(data[l])
-            if i:
-                res[-1] = chr(ord(res[-1]) + ((c & mask) << (8 - i)))
-            if i != 7:
-                res.append(chr(c >> i))
-
-            i += 1
-            mask = (mask << 1) + 1
-            if i % 8 == 0:
-                i = 0
-                mask = 0x0
-            l += 1
-
-        return hexlify(''.join(res))
+        # Returns the packed septets of data, in hex
+        return b2h(pack_septets(encode_gsm_3_38(data)))
 
     def convertTimestamp(self, ts):
-        return ''
-        # 2050107034146B
-        self.timetuple = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-
-        self.timetuple[0] = int(ts[0]) + int(ts[1]) * 10
-        if self.timetuple[0] >= 80:
-            # Convert to previous century, hopefully no one uses this after 2079 ;)
-            self.timetuple[0] += 1900
-        else:
-            # Convert to current century
-            self.timetuple[0] += 2000
-
-        # ~ print ts
-        self.timetuple[1] = int(ts[2]) + int(ts[3]) * 10
-        self.timetuple[2] = int(ts[4]) + int(ts[5]) * 10
-        self.timetuple[3] = int(ts[6]) + int(ts[7]) * 10
-        self.timetuple[4] = int(ts[8]) + int(ts[9]) * 10
-        self.timetuple[5] = int(ts[10]) + int(ts[11]) * 10
-        self.timetuple[6] = calendar.weekday(self.timetuple[0], self.timetuple[1], self.timetuple[2])
-
-        return time.asctime(self.timetuple)
+        # 2050107034146B, in hex or bytes
+        if isinstance(ts, str):
+            ts = unhexlify(ts)
+        self.time, self.timezone = decodeTimestamp(ts)
+        self._timetuple = _PENDING
+        return formatTimestamp(self.time, self.timezone)
 
     def convertDateToTimestamp(self, date):
         # Mon May 01 07:43:41 2002
@@ -246,6 +402,66 @@ class SMSmessage:
         return ts + '00'
 
 
+def decodeRecords(data, size=SMS_RECORD_SIZE):
+    """Decodes the SMS of a whole EF_SMS dump, or of several dumps put
+    together : data holds the records one after the other, size bytes each.
+    As with smsFromData, each message only keeps its record, its fields are
+    decoded on access.
+
+       return : list of tuple(index, SMSmessage) for the records in use,
+                index counting the records of data from 0
+    """
+    data = bytes(data)
+    result = []
+    for i in range(len(data) // size):
+        record = data[i * size:(i + 1) * size]
+        if record[0]:
+            s = SMSmessage()
+            s.smsFromData(record)
+            result.append((i, s))
+    return result
+
+
+def reassembleMessages(messages):
+    """Puts the segments of concatenated messages back together, in a
+    single pass over messages, a list of tuple(rec_no, message) with rec_no
+    the record each message was read from. Segments are grouped by sender,
+    reference and number of segments.
+
+    Returns a list of tuple(message, segments, missing), in the order the
+    messages (or their first segment) appear : message is the message
+    itself if it isn't concatenated, else a copy of its first segment
+    found holding the whole text, segments the list of the tuple(rec_no,
+    message) it was made of and missing the list of the sequence numbers
+    not found.
+    """
+    result = []
+    groups = {}  # (number, reference, total) -> (index in result, segments)
+    for item in messages:
+        m = item[1]
+        info = m.concatInfo() if m.udh else None
+        if info is None or not 1 <= info[2] <= info[1]:
+            result.append((m, [item], []))
+            continue
+        ref, total, seq = info
+        key = (m.number, ref, total)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (len(result), [None] * total)
+            result.append(None)
+        if group[1][seq - 1] is None:
+            group[1][seq - 1] = item
+
+    for index, parts in groups.values():
+        segments = [item for item in parts if item is not None]
+        whole = copy.copy(segments[0][1])
+        whole.message = ''.join([m.message for rec_no, m in segments])
+        missing = [i + 1 for i, item in enumerate(parts) if item is None]
+        result[index] = (whole, segments, missing)
+
+    return [r for r in result if r is not None]
+
+
 abbrevMonthNames = {"Jan": '01', "Feb": '02', "Mar": '03', "Apr": '04', "May": '05', "Jun": '06', "Jul": '07',
                     "Aug": '08', "Sep": '09', "Oct": '10', "Nov": '11', "Dec": '12'}
 
@@ -257,7 +473,7 @@ def strptime(date):
     spt = sp[3].split(':')
 
     df[0] = int(sp[4])  # Year
-    if abbrevMonthNames.has_key(sp[1]):
+    if sp[1] in abbrevMonthNames:
         df[1] = int(abbrevMonthNames[sp[1]])
     else:
         df[1] = 1  # Month
@@ -265,6 +481,6 @@ def strptime(date):
     df[3] = int(spt[0])  # Hour
     df[4] = int(spt[1])  # Minute
     df[5] = int(spt[2])  # Second
-    df[6] = calendar.weekday(df[0], df[1], df[2])
+    df[6] = (_epochDays(df[0], df[1], df[2]) + 3) % 7  # 1970-01-01 was a Thursday
 
     return df
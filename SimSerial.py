@@ -23,93 +23,220 @@
 
 from __future__ import absolute_import
 
+import os
 import serial
+import threading
 import time
 
+from atr import Atr, atr_missing, pps_request
 from exceptions import NoCardError, ProtocolError
 from LinkBase import LinkBase
-from utils import h2b, b2h
+from utils import b2h
 import sys, glob
 
 
 class SerialSimLink(LinkBase):
 
-    def __init__(self, rst='-rts', debug=False):
+    # Card polling periods (s) : modem status line, and card probing which
+    # backs off from POLL_MIN to POLL_MAX while nothing changes
+    LINE_POLL = 0.02
+    POLL_MIN = 0.05
+    POLL_MAX = 0.5
+
+    # How long to wait for the ATR (s), ISO 7816-3 wants it within 40000
+    # clock cycles of the reset, ~11 ms at 3.58 MHz
+    ATR_TIMEOUT = 0.1
+
+    # Silence (s) ending the bytes some cards send past the announced ATR
+    ATR_EXTRA_TIMEOUT = 0.02
+
+    def __init__(self, rst='-rts', debug=False, presence=None, check_echo=False):
+        """rst        : reset pin and polarity ('-rts', '+dtr', ...)
+           presence   : modem status line wired to the card presence switch
+                        of the reader ('cd', 'dsr', 'cts' or 'ri', prefixed
+                        with '!' if active low). None to detect cards by
+                        talking to them.
+           check_echo : compare what comes back on the tied TX/RX lines to
+                        what was sent (debugging of the reader wiring).
+                        The echo is always consumed, along with the answer
+                        following it.
+        """
         self._sl = None
         self._rst_pin = rst
         self._debug = debug
+        self._check_echo = check_echo
+        if presence is not None and presence.lstrip('!') not in ('cd', 'dsr', 'cts', 'ri'):
+            raise ValueError('Invalid presence line %s' % presence)
+        self._presence = presence
+        self._baudrate = 9600
+        self._max_baudrate = None
+        self._pps_failed = set()
+        self.atr = None
 
     def __del__(self):
         if self._sl:
             self._sl.close()
 
-    def scan_serial_ports(self):
+    # Last scan result, shared by all the links : (device list, usable ports)
+    _scan_cache = None
+
+    def scan_serial_ports(self, timeout=0.5, use_cache=True):
         """ Lists serial port names
 
+            Every candidate device is tried concurrently, those which
+            can't be opened within timeout seconds are left out. The result
+            is reused until devices appear or disappear (hotplug).
+
             :raises EnvironmentError:
                 On unsupported or unknown platforms
             :returns:
                 A list of the serial ports available on the system
         """
+        signature = None
         if sys.platform.startswith('win'):
             ports = ['COM%s' % (i + 1) for i in range(256)]
         elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
             # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
+            ports = [p for p in glob.glob('/dev/tty[A-Za-z]*') if self._is_hw_port(p)]
+            signature = tuple(sorted(ports))
         elif sys.platform.startswith('darwin'):
             ports = glob.glob('/dev/tty.*')
+            signature = tuple(sorted(ports))
         else:
             raise EnvironmentError('Unsupported platform')
 
-        result = []
-        for port in ports:
+        cache = SerialSimLink._scan_cache
+        if use_cache and signature is not None and cache and cache[0] == signature:
+            return list(cache[1])
+
+        found = []
+
+        def probe(port):
             try:
                 s = serial.Serial(port)
                 s.close()
-                result.append(port)
+                found.append(port)
             except (OSError, serial.SerialException):
                 pass
-        return result
+
+        threads = []
+        for port in ports:
+            t = threading.Thread(target=probe, args=(port,))
+            t.daemon = True  # Some devices block on open, don't wait for them
+            t.start()
+            threads.append(t)
+        deadline = time.time() + timeout
+        for t in threads:
+            t.join(max(0, deadline - time.time()))
+
+        result = [p for p in ports if p in found]
+        if signature is not None:
+            SerialSimLink._scan_cache = (signature, result)
+        return list(result)
+
+    @staticmethod
+    def _is_hw_port(port):
+        """Tells from sysfs whether a Linux tty is backed by a device (USB
+        adapter, UART, ...) rather than a virtual console or a pty. Without
+        sysfs, every port is considered."""
+        sysfs = '/sys/class/tty/' + os.path.basename(port)
+        if not os.path.isdir('/sys/class/tty'):
+            return True
+        if not os.path.exists(sysfs + '/device'):
+            return False
+        try:
+            # Legacy 8250 ports without an actual UART behind are of type 0
+            with open(sysfs + '/type') as f:
+                return f.read().strip() != '0'
+        except (IOError, OSError):
+            return True
+
+    def _card_present(self):
+        """Reads the card presence line, None if there is none"""
+        if self._presence is None:
+            return None
+        state = bool(getattr(self._sl, self._presence.lstrip('!')))
+        return state != self._presence.startswith('!')
+
+    def _probe_card(self):
+        """Tells if the card reset last is still there, with a STATUS
+        rather than a reset so it's quick and doesn't disturb the card"""
+        timeout = self._sl.timeout
+        self._sl.timeout = self.ATR_TIMEOUT
+        try:
+            data, sw = self.send_apdu_raw_bytes(b'\xa0\xf2\x00\x00\x0d')
+            return sw is not None
+        except ProtocolError:
+            return False
+        finally:
+            self._sl.timeout = timeout
 
     def wait_for_card(self, timeout=None, newcardonly=False):
+        mt = time.time() + timeout if timeout is not None else None
+
         # Direct try
         existing = False
 
-        try:
-            self.reset_card()
-            if not newcardonly:
-                return
-            else:
-                existing = True
-        except NoCardError:
-            pass
+        if newcardonly and self._card_present() is not False and self._probe_card():
+            # Don't reset a card which is already there, it's going to
+            # be ignored anyway
+            existing = True
+        elif self._card_present() is not False:
+            try:
+                self.reset_card()
+                if not newcardonly:
+                    return
+                else:
+                    existing = True
+            except NoCardError:
+                pass
 
         # Poll ...
-        mt = time.time() + timeout if timeout is not None else None
         pe = 0
+        delay = self.POLL_MIN
 
         while (mt is None) or (time.time() < mt):
+            present = self._card_present()
+            if present is not None:
+                # The reader tells us, only reset once a new card is in
+                if not present:
+                    existing = False
+                if existing or not present:
+                    time.sleep(self.LINE_POLL)
+                    continue
+            else:
+                time.sleep(delay)
+                delay = min(delay * 1.5, self.POLL_MAX)
+                if existing:
+                    if not self._probe_card():
+                        # Removed, watch closely for the next one
+                        existing = False
+                        delay = self.POLL_MIN
+                    continue
+
             try:
-                time.sleep(0.5)
                 self.reset_card()
-                if not existing:
-                    return
+                return
             except NoCardError:
-                existing = False
+                pass
             except ProtocolError:
-                if existing:
-                    existing = False
-                else:
-                    # Tolerate a couple of protocol error ... can happen if
-                    # we try when the card is 'half' inserted
-                    pe += 1
-                    if (pe > 2):
-                        raise
+                # Tolerate a couple of protocol error ... can happen if
+                # we try when the card is 'half' inserted
+                pe += 1
+                if (pe > 2):
+                    raise
 
         # Timed out ...
         raise NoCardError()
 
-    def connect(self, device='/dev/ttyUSB0', baudrate=9600):
+    def connect(self, device='/dev/ttyUSB0', baudrate=9600, max_baudrate=None):
+        """baudrate     : rate of the reader at the default Fi/Di (372/1)
+           max_baudrate : if set, the rate is raised up to it with a PPS
+                          exchange after each reset, as far as the card
+                          and the serial port allow
+        """
+        self._baudrate = baudrate
+        self._max_baudrate = max_baudrate
         self._sl = serial.Serial(
             port=device,
             parity=serial.PARITY_EVEN,
@@ -145,6 +272,18 @@ class SerialSimLink(LinkBase):
         except:
             raise ValueError('Invalid reset pin %s' % self._rst_pin);
 
+        timeout = self._sl.timeout
+        self._sl.timeout = self.ATR_TIMEOUT
+        try:
+            return self._reset_card_atr(rst_meth, rst_val)
+        finally:
+            self._sl.timeout = timeout
+
+    def _reset_card_atr(self, rst_meth, rst_val):
+        self.atr = None
+        if self._sl.baudrate != self._baudrate:
+            self._sl.baudrate = self._baudrate
+
         rst_meth(rst_val)
         time.sleep(0.1)  # 100 ms
         self._sl.flushInput()
@@ -162,102 +301,164 @@ class SerialSimLink(LinkBase):
 
         if not b:
             return -1
-        t0 = ord(b)
-        self._dbg_print("T0: 0x%x" % t0)
 
-        for i in range(4):
-            if t0 & (0x10 << i):
-                self._dbg_print("T%si = %x" % (chr(ord('A') + i), ord(self._rx_byte())))
-
-        for i in range(0, t0 & 0xf):
-            self._dbg_print("Historical = %x" % ord(self._rx_byte()))
+        # Read exactly what the ATR announces, no need to wait for a timeout
+        data = bytearray(b'\x3b' + b)
+        n = atr_missing(data)
+        while n:
+            chunk = self._rx_bytes(n)
+            if len(chunk) < n:
+                return -1
+            data += chunk
+            n = atr_missing(data)
 
+        try:
+            atr = Atr(data)
+        except ProtocolError:
+            return -1
+        # Some cards send more than they announce (ex. a TCK in T=0 only),
+        # it would be taken for the answer to the next command
+        self._sl.timeout = self.ATR_EXTRA_TIMEOUT
         while True:
-            x = self._rx_byte()
+            x = self._sl.read(32)
             if not x:
                 break
-            self._dbg_print("Extra: %x" % ord(x))
+            self._dbg_print("Extra: %s" % b2h(x))
+        self._sl.timeout = self.ATR_TIMEOUT
+
+        self._dbg_print("ATR: %s%s" % (atr, '' if atr.checksum_ok else ' (bad TCK)'))
+        self._dbg_print("Fi=%s Di=%s N=%d T=%s Historical=%s" % (atr.f, atr.d,
+            atr.extra_guard, atr.protocols, b2h(atr.historical)))
+        self.atr = atr
+
+        if atr.specific and not atr.implicit_params:
+            # The card runs at the rate of TA1 straight away, the default
+            # one is kept if it's RFU or the port can't do it
+            if atr.f is not None and atr.d is not None:
+                try:
+                    self._sl.baudrate = self._baudrate * 372 * atr.d // atr.f
+                except (ValueError, serial.SerialException):
+                    self._sl.baudrate = self._baudrate
+        elif self._max_baudrate and atr.raw not in self._pps_failed:
+            if not self._pps(atr):
+                # The card is left in an unknown state, start over without PPS
+                self._pps_failed.add(atr.raw)
+                return self._reset_card_atr(rst_meth, rst_val)
 
         return 1
 
+    def _pps(self, atr):
+        """Negotiates the fastest rate up to max_baudrate, True unless the
+        card or the serial port couldn't be switched"""
+        params = atr.pps_params(self._baudrate, self._max_baudrate)
+        if params is None:
+            return True
+        fi, di, rate = params
+
+        req = pps_request(atr.protocols[0], fi, di)
+        self._dbg_print("PPS: %s (%d bps)" % (b2h(req), rate))
+        try:
+            # The card repeats the request when accepting it
+            self._sl.write(req)
+            r = self._rx_bytes(2 * len(req))
+            self._echo(req, r)
+            if bytes(r[len(req):]) != req:
+                return False
+            self._sl.baudrate = rate
+        except (ProtocolError, ValueError, serial.SerialException):
+            return False
+        return True
+
     def _dbg_print(self, s):
         if self._debug:
             print(s)
 
-    def _tx_byte(self, b):
-        self._sl.write(b)
-        r = self._sl.read()
-        if r != b:  # TX and RX are tied, so we must clear the echo
-            raise ProtocolError("Bad echo value. Expected %02x, got %s)" % (ord(b), '%02x' % ord(r) if r else '(nil)'))
-
-    def _tx_string(self, s):
-        """This is only safe if it's guaranteed the card won't send any data
-        during the time of tx of the string !!!"""
-        self._sl.write(s)
-        r = self._sl.read(len(s))
-        if r != s:  # TX and RX are tied, so we must clear the echo
-            raise ProtocolError("Bad echo value (Expected: %s, got %s)" % (b2h(s), b2h(r)))
+    def _echo(self, s, r):
+        """Checks the echo of s at the start of r. TX and RX are tied, so it
+        has to be read anyway, but it's only compared with check_echo."""
+        if len(r) < len(s) or (self._check_echo and r[:len(s)] != s):
+            raise ProtocolError("Bad echo value (Expected: %s, got %s)" % (b2h(s), b2h(r[:len(s)])))
 
     def _rx_byte(self):
         return self._sl.read()
 
-    def send_apdu_raw(self, pdu):
-        """see LinkBase.send_apdu_raw"""
+    def _rx_bytes(self, n, skip_null=False):
+        """Receives n bytes into a preallocated buffer using as few driver
+        reads as possible. With skip_null, NULL procedure bytes (0x60) sent
+        before the first byte are dropped. Returns less than n bytes only if
+        the read timed out."""
+        buf = bytearray(n)
+        got = 0
+        while got < n:
+            chunk = self._sl.read(n - got)
+            if not chunk:
+                break
+            if skip_null and not got:
+                chunk = chunk.lstrip(b'\x60')
+            buf[got:got + len(chunk)] = chunk
+            got += len(chunk)
+        del buf[got:]
+        return buf
 
-        self._dbg_print("Command:" + pdu)
-        pdu1 = h2b(pdu)
-        data_len = int(pdu[8:11], 16)  # P3
+    def send_apdu_raw_bytes(self, pdu):
+        """see LinkBase.send_apdu_raw_bytes"""
 
-        # Send first CLASS,INS,P1,P2,P3
-        pdu2 = pdu1[0:5]
-        self._tx_string(pdu1[0:5])
+        if self._debug:
+            self._dbg_print("Command:" + b2h(pdu))
+        pdu1 = bytes(pdu)
+        ins = pdu1[1]
+
+        # Send first CLASS,INS,P1,P2,P3, its echo and the procedure byte
+        # come back in one read
+        self._sl.write(pdu1[0:5])
+        r = self._rx_bytes(6)
+        self._echo(pdu1[0:5], r)
+        b = r[5:]
 
         # Wait ack which can be
         #  - INS: Command acked -> go ahead
         #  - 0x60: NULL, just wait some more
         #  - SW1: The card can apparently proceed ...
         while True:
-            b = self._rx_byte()
-            x = pdu[2:4]
-            y = b2h(b)
-            if x == y:
+            if not b:
+                raise ProtocolError("No procedure byte received")
+            if b[0] == ins:
                 break
-            elif b != '\x60':
+            elif b[0] != 0x60:
                 # Ok, it 'could' be SW1
-                sw1 = b
                 sw2 = self._rx_byte()
-                nil = self._rx_byte()
-                if (sw2 and not nil):
-                    return '', b2h(sw1 + sw2)
+                if sw2:
+                    return b'', (b[0] << 8) | sw2[0]
 
                 raise ProtocolError()
-
-        # Send data (if any)
-        if len(pdu) > 5:
-            pdu2 = pdu1[5:]
-            self._tx_string(pdu2)
-
-        # Receive data (including SW !)
-        #  length = [P3 - tx_data (=len(pdu)-len(hdr)) + 2 (SW1/2) ]
-        to_recv = data_len - len(pdu)/2 + 5 + 4
-        to_recv = data_len + 2
-
-        data = ''
-        while (len(data)/2 < to_recv + 1):
             b = self._rx_byte()
-            if (to_recv == 2) and (b == '\x60'):  # Ignore NIL if we have no RX data (hack ?)
-                continue
-            if not b:
-                break;
-            data += b2h(b)
 
-        # Split datafield from SW
-        if len(data) < 4:
+        # Send data (if any). A command carrying data only gets the SW back,
+        # read along with the data echo, otherwise P3 is the number of bytes
+        # the card is going to send, read along with the SW.
+        if len(pdu1) > 5:
+            n = len(pdu1) - 5
+            self._sl.write(pdu1[5:])
+            r = self._rx_bytes(n + 2)
+            self._echo(pdu1[5:], r)
+            data = b''
+        else:
+            n = pdu1[4]
+            r = self._rx_bytes(n + 2)
+            data = r[:n]
+
+        # NULL bytes can show up between the data and the SW. Nothing more
+        # is read if the data already timed out.
+        sw = r[n:].lstrip(b'\x60')
+        if len(sw) < 2 and len(r) >= n:
+            sw += self._rx_bytes(2 - len(sw), skip_null=not sw)
+        if len(sw) < 2:
             return None, None
-        sw = data[-4:]
-        data = data[0:-4]
+        sw = (sw[0] << 8) | sw[1]
+        data = bytes(data)
 
-        self._dbg_print("SW: " + sw)
-        self._dbg_print("Data: " + data)
+        if self._debug:
+            self._dbg_print("SW: %04x" % sw)
+            self._dbg_print("Data: " + b2h(data))
         # Return value
         return data, sw
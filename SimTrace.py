@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Transport Links recording and replaying APDU sessions
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import time
+
+from exceptions import NoCardError, ProtocolError
+from LinkBase import LinkBase
+from utils import b2h, h2b
+
+
+# The trace is a text file with one event per line :
+#
+#   <latency in us> A <command> <data> <sw>    an APDU ('-' for no data)
+#   <latency in us> R                          a card reset
+#   <latency in us> N                          a reset that found no card
+#
+# ex. "48210 A a0a40000023f00 - 9f16"
+
+
+class RecordingLink(LinkBase):
+    """Wraps another LinkBase and logs every APDU and reset going through
+    it, along with how long it took.
+
+       link     : the LinkBase to record
+       filename : trace file to write, None to only keep the statistics
+    """
+
+    def __init__(self, link, filename=None):
+        self._link = link
+        self._f = open(filename, 'w') if filename else None
+        self.reset_stats()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def reset_stats(self):
+        self.apdu_count = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.total_time = 0.0
+
+    def _log(self, t, line):
+        self.total_time += t
+        if self._f:
+            self._f.write('%d %s\n' % (int(t * 1e6), line))
+
+    def wait_for_card(self, timeout=None, newcardonly=False):
+        t = time.time()
+        try:
+            self._link.wait_for_card(timeout, newcardonly)
+        except NoCardError:
+            self._log(time.time() - t, 'N')
+            raise
+        self._log(time.time() - t, 'R')
+
+    def connect(self, *args, **kwargs):
+        return self._link.connect(*args, **kwargs)
+
+    def disconnect(self):
+        self.close()
+        return self._link.disconnect()
+
+    def reset_card(self):
+        t = time.time()
+        try:
+            self._link.reset_card()
+        except NoCardError:
+            self._log(time.time() - t, 'N')
+            raise
+        self._log(time.time() - t, 'R')
+
+    def send_apdu_raw_bytes(self, pdu):
+        """see LinkBase.send_apdu_raw_bytes"""
+        t = time.time()
+        data, sw = self._link.send_apdu_raw_bytes(pdu)
+        t = time.time() - t
+
+        self.apdu_count += 1
+        self.bytes_tx += len(pdu)
+        self.bytes_rx += (len(data) if data else 0) + 2
+        if self._f:
+            self._log(t, 'A %s %s %s' % (b2h(pdu), b2h(data) if data else '-',
+                                         '-' if sw is None else '%04x' % sw))
+        else:
+            self.total_time += t
+        return data, sw
+
+
+class ReplayLink(LinkBase):
+    """Serves the responses of a trace written by RecordingLink.
+
+       filename : trace file
+       realtime : if True, each event takes as long as when recorded
+       strict   : if True, the commands must come in the very same order as
+                  when recording. Otherwise each command is answered with
+                  what the card answered to it in the same context (last
+                  file selected, command before a GET RESPONSE), so that
+                  code sending fewer or reordered APDUs can be replayed.
+    """
+
+    def __init__(self, filename, realtime=False, strict=True):
+        self.realtime = realtime
+        self.strict = strict
+        self._events = []
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                args = fields[2:]
+                if fields[1] == 'A':
+                    # Decoded once, replaying is then free of any hex
+                    cmd, data, sw = args
+                    args = (bytes(h2b(cmd)),
+                            b'' if data == '-' else bytes(h2b(data)),
+                            None if sw == '-' else int(sw, 16))
+                self._events.append((int(fields[0]) / 1e6, fields[1], args))
+
+        # Index for the non strict mode : key -> list of (latency, data, sw)
+        self._index = {}
+        self._ctx = None
+        for t, k, args in self._events:
+            if k == 'A':
+                self._index.setdefault(self._key(args[0]), []).append((t, args[1], args[2]))
+                self._track(args[0])
+        self.rewind()
+
+    def rewind(self):
+        self._pos = 0
+        self._used = {}
+        self._ctx = None
+        self._prev = None
+        self.apdu_count = 0
+        self.recorded_time = 0.0
+
+    def _key(self, cmd):
+        if cmd[1] == 0xa4:  # SELECT only depends on the file
+            return cmd
+        if cmd[1] == 0xc0:  # GET RESPONSE depends on the previous command
+            return (self._prev, cmd)
+        return (self._ctx, cmd)
+
+    def _track(self, cmd):
+        if cmd[1] == 0xa4:
+            self._ctx = cmd[5:7]
+        self._prev = cmd
+
+    def _wait(self, t):
+        self.recorded_time += t
+        if self.realtime:
+            time.sleep(t)
+
+    def _next(self, kind):
+        if self._pos >= len(self._events):
+            raise ProtocolError("End of trace reached")
+        t, k, args = self._events[self._pos]
+        if k != kind and not (kind == 'R' and k == 'N'):
+            raise ProtocolError("Trace mismatch at event %d: expected %s, got %s" % (self._pos + 1, k, kind))
+        self._pos += 1
+        self._wait(t)
+        return k, args
+
+    def wait_for_card(self, timeout=None, newcardonly=False):
+        self.reset_card()
+
+    def connect(self, device=None, baudrate=9600):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def reset_card(self):
+        self._ctx = None
+        self._prev = None
+        if not self.strict:
+            return
+        k, args = self._next('R')
+        if k == 'N':
+            raise NoCardError()
+
+    def send_apdu_raw_bytes(self, pdu):
+        """see LinkBase.send_apdu_raw_bytes"""
+        pdu = bytes(pdu)
+        if self.strict:
+            k, (cmd, data, sw) = self._next('A')
+            if cmd != pdu:
+                raise ProtocolError("Trace mismatch at event %d: expected %s, got %s" % (self._pos, b2h(cmd), b2h(pdu)))
+        else:
+            key = self._key(pdu)
+            answers = self._index.get(key)
+            if not answers:
+                raise ProtocolError("Command %s not found in trace" % b2h(pdu))
+            # Same answers in the recorded order, the last one repeating
+            i = self._used.get(key, 0)
+            self._used[key] = i + 1
+            t, data, sw = answers[min(i, len(answers) - 1)]
+            self._wait(t)
+            self._track(pdu)
+
+        self.apdu_count += 1
+        if sw is None:
+            return None, None
+        return data, sw
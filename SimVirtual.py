@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: Transport Link simulating a TS 11.11 SIM card in memory
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import time
+
+from exceptions import NoCardError
+from LinkBase import LinkBase
+from utils import rpad, b2h
+
+
+# A card image describes the card declaratively, as a dict (or the same
+# thing in a JSON file) :
+#
+#  {
+#    'chv1': '1234', 'chv1_enabled': True, 'puk1': '12345678',
+#    'chv2': '5678', 'puk2': '87654321', 'ki': '00112233...',
+#    'files': {
+#      '3f00': {},                                  # MF / DF
+#      '3f00/2fe2': {'data': '98...'},              # transparent EF
+#      '3f00/7f10/6f3c': {'rec_len': 176,           # linear fixed EF
+#                         'records': ['01...'],     #  (missing records
+#                         'rec_count': 30},         #   are all 'ff')
+#    }
+#  }
+#
+# EFs may also give 'size' (transparent, data padded with 'ff'), 'empty'
+# (content of the missing records) and 'access' (the 3 access condition
+# bytes of TS 11.11 section 9.3, in hex).
+
+def blank_card_image(sms=(), adn=(), sms_count=30, adn_count=100):
+    """Returns the image of a plain GSM SIM with an unset CHV1 (0000), the
+    given EF_SMS records (176 bytes each) and EF_ADN records (28 bytes each)"""
+    return {
+        'chv1': '0000', 'chv1_enabled': False, 'puk1': '12345678',
+        'chv2': '0000', 'puk2': '12345678',
+        'ki': '000102030405060708090a0b0c0d0e0f',
+        'files': {
+            '3f00': {},
+            '3f00/2fe2': {'data': '981032547698103254f6', 'access': '0f44ff'},
+            '3f00/7f10': {},
+            '3f00/7f10/6f3a': {'rec_len': 28, 'records': list(adn), 'rec_count': adn_count, 'access': '1144ff'},
+            '3f00/7f10/6f3c': {'rec_len': 176, 'records': list(sms), 'rec_count': sms_count, 'access': '1144ff',
+                               'empty': '00' + 'ff' * 175},
+            '3f00/7f10/6f40': {'rec_len': 28, 'records': [], 'rec_count': 2, 'access': '1144ff'},
+            '3f00/7f20': {},
+            '3f00/7f20/6f05': {'data': '01ffff', 'access': '0144ff'},
+            '3f00/7f20/6f07': {'data': '082926540000000010', 'access': '1444ff'},
+            '3f00/7f20/6f20': {'data': 'ffffffffffffffff07', 'access': '1144ff'},
+            '3f00/7f20/6f31': {'data': '0a', 'access': '1444ff'},
+            '3f00/7f20/6f38': {'data': 'ff3fffff3f0000', 'access': '1444ff'},
+            '3f00/7f20/6f46': {'size': 17, 'access': '0444ff'},
+            '3f00/7f20/6f74': {'size': 16, 'access': '1144ff'},
+            '3f00/7f20/6f78': {'data': '0001', 'access': '1444ff'},
+            '3f00/7f20/6f7b': {'size': 12, 'access': '1144ff'},
+            '3f00/7f20/6f7e': {'data': 'ffffffff62f2100000ff01', 'access': '1144ff'},
+            '3f00/7f20/6fad': {'data': '000000', 'access': '0444ff'},
+            '3f00/7f20/6fae': {'data': '02', 'access': '0f44ff'},
+        },
+    }
+
+
+def load_card_image(filename):
+    """Loads a card image from a JSON file"""
+    with open(filename) as f:
+        return json.load(f)
+
+
+class _Chv(object):
+
+    def __init__(self, code, unblock, enabled=True, tries=3, unblock_tries=10):
+        self.code = rpad(b2h(code.encode()), 16) if code is not None else None
+        self.unblock = rpad(b2h(unblock.encode()), 16) if unblock is not None else None
+        self.enabled = enabled
+        self.verified = False
+        self.tries = tries
+        self.max_tries = tries
+        self.unblock_tries = unblock_tries
+        self.max_unblock_tries = unblock_tries
+
+    def status_byte(self):
+        return (0x80 if self.code is not None else 0) | self.tries
+
+    def unblock_status_byte(self):
+        return (0x80 if self.unblock is not None else 0) | self.unblock_tries
+
+    def check(self, code):
+        """Presents code, returns the SW"""
+        if self.code is None or self.tries == 0:
+            return 0x9840
+        if code != self.code:
+            self.tries -= 1
+            self.verified = False
+            return 0x9804 if self.tries else 0x9840
+        self.tries = self.max_tries
+        self.verified = True
+        return 0x9000
+
+
+class VirtualSimLink(LinkBase):
+    """A LinkBase talking to an in-memory TS 11.11 SIM card.
+
+       image    : card image (see blank_card_image), None for a blank card
+       baudrate : rate used to compute the wire time of each APDU
+       latency  : if True, each APDU actually takes its wire time
+    """
+
+    def __init__(self, image=None, baudrate=9600, latency=False):
+        self.baudrate = baudrate
+        self.latency = latency
+        self._inserted = 0
+        self.reset_stats()
+        self.insert_card(image if image is not None else blank_card_image())
+
+    def reset_stats(self):
+        self.apdu_count = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.wire_time = 0.0
+
+    def insert_card(self, image):
+        """Puts a new card (from its image) into the simulated reader"""
+        self._files = {}
+        for path, spec in image.get('files', {}).items():
+            self._files[tuple(path.lower().split('/'))] = self._load_file(spec, path)
+        self._chv = {
+            1: _Chv(image.get('chv1'), image.get('puk1'), image.get('chv1_enabled', True)),
+            2: _Chv(image.get('chv2'), image.get('puk2')),
+        }
+        self._ki = bytes.fromhex(image.get('ki', '00' * 16))
+        self._inserted += 1
+        self._present = True
+        self._powered = False
+        self.reset_card()
+
+    def remove_card(self):
+        self._present = False
+        self._powered = False
+
+    def _load_file(self, spec, path):
+        node = {'fid': path.lower().split('/')[-1], 'access': bytes.fromhex(spec.get('access', '000000'))}
+        if 'records' in spec or 'rec_len' in spec:
+            rec_len = spec['rec_len']
+            records = [bytearray.fromhex(rpad(r, rec_len * 2)) for r in spec.get('records', [])]
+            empty = spec.get('empty', 'ff' * rec_len)
+            while len(records) < spec.get('rec_count', len(records)):
+                records.append(bytearray.fromhex(empty))
+            node.update(type='ef', structure=0x01, rec_len=rec_len, records=records)
+        elif 'data' in spec or 'size' in spec:
+            data = spec.get('data', '')
+            size = spec.get('size', len(data) // 2)
+            node.update(type='ef', structure=0x00, data=bytearray.fromhex(rpad(data, size * 2)))
+        else:
+            node.update(type='df')
+        return node
+
+    def wait_for_card(self, timeout=None, newcardonly=False):
+        mt = time.time() + timeout if timeout is not None else None
+        inserted = self._inserted if (newcardonly and self._present) else None
+        while True:
+            if self._present and self._inserted != inserted:
+                self.reset_card()
+                return
+            if (mt is not None) and (time.time() >= mt):
+                raise NoCardError()
+            time.sleep(0.01)
+
+    def connect(self, device=None, baudrate=9600):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def reset_card(self):
+        if not self._present:
+            raise NoCardError()
+        self._powered = True
+        self._cur_df = ('3f00',)
+        self._cur_ef = None
+        self._rec_ptr = 0
+        self._response = b''
+        for chv in self._chv.values():
+            chv.verified = False
+
+    # Card side
+
+    def _df_response(self, path):
+        chv1, chv2 = self._chv[1], self._chv[2]
+        children = [p for p in self._files if len(p) == len(path) + 1 and p[:-1] == path]
+        n_df = len([p for p in children if self._files[p]['type'] == 'df'])
+        return bytes([
+            0x00, 0x00, 0x00, 0x00,
+        ]) + bytes.fromhex(path[-1]) + bytes([
+            0x01 if len(path) == 1 else 0x02,
+            0x00, 0x00, 0x00, 0x00, 0x00,
+            0x09,  # Length of the GSM data
+            0x00 if chv1.enabled else 0x80,  # File characteristics
+            n_df, len(children) - n_df, 4, 0x00,
+            chv1.status_byte(), chv1.unblock_status_byte(),
+            chv2.status_byte(), chv2.unblock_status_byte(),
+        ])
+
+    def _ef_response(self, node):
+        if node['structure'] == 0x00:
+            size, rec_len = len(node['data']), 0
+        else:
+            size, rec_len = node['rec_len'] * len(node['records']), node['rec_len']
+        return bytes([0x00, 0x00, size >> 8, size & 0xff]) + bytes.fromhex(node['fid']) + \
+            bytes([0x04, 0x00]) + node['access'] + bytes([0x01, 0x02, node['structure'], rec_len])
+
+    def _chv_ok(self, chv_no):
+        chv = self._chv[chv_no]
+        return chv.verified or (chv_no == 1 and not chv.enabled)
+
+    def _allowed(self, node, shift):
+        """Checks the access condition nibble of byte 9 at shift (4: READ /
+        SEEK, 0: UPDATE)"""
+        cond = (node['access'][0] >> shift) & 0xf
+        if cond == 0:
+            return True
+        if cond in (1, 2):
+            return self._chv_ok(cond)
+        return False
+
+    def _select(self, fid):
+        cur = self._cur_df
+        candidates = [('3f00',), cur, cur[:-1], cur + (fid,)]
+        if len(cur) > 1:
+            candidates.append(cur[:-1] + (fid,))
+        for path in candidates:
+            if not path or path[-1] != fid or path not in self._files:
+                continue
+            node = self._files[path]
+            if node['type'] == 'df':
+                self._cur_df = path
+                self._cur_ef = None
+                resp = self._df_response(path)
+            elif path[:-1] == cur:
+                self._cur_ef = path
+                self._rec_ptr = 0
+                resp = self._ef_response(node)
+            else:
+                continue  # EFs of the parent DF aren't selectable
+            return self._reply(resp)
+        return b'', 0x9404
+
+    def _reply(self, resp):
+        """Keeps resp for GET RESPONSE and returns the 9Fxx SW"""
+        self._response = resp
+        return b'', 0x9f00 | len(resp)
+
+    def _current_ef(self, structure):
+        if self._cur_ef is None:
+            return None, 0x9400
+        node = self._files[self._cur_ef]
+        if node['structure'] != structure:
+            return None, 0x9408
+        return node, 0x9000
+
+    def _record_no(self, node, p1, p2):
+        n = len(node['records'])
+        if p2 == 0x04:
+            rec_no = p1 or self._rec_ptr
+        elif p2 == 0x02:
+            rec_no = self._rec_ptr + 1 if self._rec_ptr else 1
+        elif p2 == 0x03:
+            rec_no = self._rec_ptr - 1 if self._rec_ptr else n
+        else:
+            return None
+        if rec_no < 1 or rec_no > n:
+            return None
+        return rec_no
+
+    def _process(self, apdu):
+        """Executes one command APDU (bytes), returns tuple(data, sw)"""
+        if len(apdu) < 5:
+            return b'', 0x6700
+        cla, ins, p1, p2, p3 = apdu[0:5]
+        body = apdu[5:]
+        if cla != 0xa0:
+            return b'', 0x6e00
+
+        if ins == 0xa4:  # SELECT
+            if p3 != 2 or len(body) != 2:
+                return b'', 0x6702
+            return self._select(b2h(body))
+
+        if ins == 0xc0:  # GET RESPONSE
+            resp = self._response
+            if not resp:
+                return b'', 0x6f00
+            if p3 > len(resp):
+                return b'', 0x6700 | len(resp)
+            return resp[:p3], 0x9000
+
+        if ins == 0xf2:  # STATUS
+            resp = self._df_response(self._cur_df)
+            if p3 > len(resp):
+                return b'', 0x6700 | len(resp)
+            return resp[:p3], 0x9000
+
+        if ins in (0xb0, 0xd6):  # READ / UPDATE BINARY
+            node, sw = self._current_ef(0x00)
+            if node is None:
+                return b'', sw
+            if not self._allowed(node, 4 if ins == 0xb0 else 0):
+                return b'', 0x9804
+            offset = (p1 << 8) | p2
+            if offset + p3 > len(node['data']):
+                return b'', 0x9402
+            if ins == 0xb0:
+                return bytes(node['data'][offset:offset + p3]), 0x9000
+            if len(body) != p3:
+                return b'', 0x6700
+            node['data'][offset:offset + p3] = body
+            return b'', 0x9000
+
+        if ins in (0xb2, 0xdc):  # READ / UPDATE RECORD
+            node, sw = self._current_ef(0x01)
+            if node is None:
+                return b'', sw
+            if not self._allowed(node, 4 if ins == 0xb2 else 0):
+                return b'', 0x9804
+            if p3 != node['rec_len']:
+                return b'', 0x6700 | node['rec_len']
+            rec_no = self._record_no(node, p1, p2)
+            if rec_no is None:
+                return b'', 0x9402
+            self._rec_ptr = rec_no
+            if ins == 0xb2:
+                return bytes(node['records'][rec_no - 1]), 0x9000
+            if len(body) != p3:
+                return b'', 0x6700
+            node['records'][rec_no - 1][:] = body
+            return b'', 0x9000
+
+        if ins == 0xa2:  # SEEK
+            node, sw = self._current_ef(0x01)
+            if node is None:
+                return b'', sw
+            if not self._allowed(node, 4):
+                return b'', 0x9804
+            rec_no_wanted, mode = p2 & 0x10, p2 & 0xf
+            n = len(node['records'])
+            if mode == 0:
+                order = range(1, n + 1)
+            elif mode == 1:
+                order = range(n, 0, -1)
+            elif mode == 2:
+                order = range(self._rec_ptr + 1, n + 1)
+            elif mode == 3:
+                order = range((self._rec_ptr or n + 1) - 1, 0, -1)
+            else:
+                return b'', 0x6b00
+            for rec_no in order:
+                if node['records'][rec_no - 1].startswith(body):
+                    self._rec_ptr = rec_no
+                    if rec_no_wanted:  # Type 2
+                        return self._reply(bytes([rec_no]))
+                    return b'', 0x9000
+            return b'', 0x9404
+
+        if ins in (0x20, 0x24, 0x26, 0x28, 0x2c):  # CHV management
+            return self._process_chv(ins, p2, body)
+
+        if ins == 0x88:  # RUN GSM ALGORITHM
+            if not self._chv_ok(1):
+                return b'', 0x9804
+            if self._cur_df != ('3f00', '7f20'):
+                return b'', 0x9400
+            h = hashlib.sha1(self._ki + bytes(body)).digest()
+            return self._reply(h[:12])
+
+        if ins == 0x10:  # TERMINAL PROFILE
+            return b'', 0x9000
+
+        return b'', 0x6d00
+
+    def _process_chv(self, ins, p2, body):
+        if ins == 0x2c:  # UNBLOCK CHV
+            chv = self._chv.get(1 if p2 == 0 else p2)
+            if chv is None or len(body) != 16:
+                return b'', 0x6b00
+            if chv.unblock_tries == 0:
+                return b'', 0x9840
+            if b2h(body[0:8]) != chv.unblock:
+                chv.unblock_tries -= 1
+                return b'', 0x9804 if chv.unblock_tries else 0x9840
+            chv.unblock_tries = chv.max_unblock_tries
+            chv.code = b2h(body[8:16])
+            chv.tries = chv.max_tries
+            chv.verified = True
+            chv.enabled = True
+            return b'', 0x9000
+
+        chv = self._chv.get(p2)
+        if chv is None:
+            return b'', 0x6b00
+        sw = chv.check(b2h(body[0:8]))
+        if sw != 0x9000:
+            return b'', sw
+        if ins == 0x24:  # CHANGE CHV
+            chv.code = b2h(body[8:16])
+        elif ins == 0x26:  # DISABLE CHV
+            chv.enabled = False
+        elif ins == 0x28:  # ENABLE CHV
+            chv.enabled = True
+        return b'', 0x9000
+
+    # Transport side
+
+    def send_apdu_raw_bytes(self, pdu):
+        """see LinkBase.send_apdu_raw_bytes"""
+        if not self._present or not self._powered:
+            raise NoCardError()
+
+        apdu = bytes(pdu)
+        data, sw = self._process(apdu)
+
+        # What would go over a T=0 serial line : header, INS ack and data
+        # if the command is accepted, then SW1 SW2
+        tx = len(apdu)
+        rx = 2 + len(data) + (1 if (len(apdu) > 5 or data) else 0)
+        self.apdu_count += 1
+        self.bytes_tx += tx
+        self.bytes_rx += rx
+        t = (tx + rx) * 12.0 / self.baudrate  # 12 etu per character
+        self.wire_time += t
+        if self.latency:
+            time.sleep(t)
+
+        return bytes(data), sw
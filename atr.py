@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" pySim: ISO 7816-3 Answer To Reset parsing and PPS
+"""
+
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from exceptions import ProtocolError
+from utils import b2h
+
+
+# Clock rate conversion integer (Fi) and baud rate adjustment integer (Di),
+# indexed by the FI / DI nibbles of TA1. None is RFU.
+FI_TABLE = (372, 372, 558, 744, 1116, 1488, 1860, None,
+            None, 512, 768, 1024, 1536, 2048, None, None)
+FMAX_TABLE = (4, 5, 6, 8, 12, 16, 20, None,
+              None, 5, 7.5, 10, 15, 20, None, None)	# MHz
+DI_TABLE = (None, 1, 2, 4, 8, 16, 32, 64,
+            12, 20, None, None, None, None, None, None)
+
+# Default FI/DI, used when TA1 is absent
+DEFAULT_FIDI = 0x11
+
+
+def atr_missing(data):
+	"""Returns how many more bytes are needed to get the whole ATR which
+	   starts with data, so that it can be read without waiting for a
+	   timeout. The count may grow as the interface bytes come in."""
+	if len(data) < 2:
+		return 2 - len(data)
+
+	pos = 1		# Offset of the byte telling which interface bytes follow
+	tck = False
+	while True:
+		y = data[pos]
+		end = pos + bin(y & 0xf0).count('1')
+		if len(data) <= end:
+			return end + 1 - len(data)
+		if not y & 0x80:
+			break
+		pos = end
+		if data[pos] & 0x0f:	# Any protocol but T=0 needs a TCK
+			tck = True
+
+	return max(0, end + 1 + (data[1] & 0x0f) + tck - len(data))
+
+
+class Atr(object):
+	"""Parsed Answer To Reset
+
+	   ts, t0      : initial and format bytes
+	   interface   : list of dicts {'ta', 'tb', 'tc', 'td'} for each group
+	                 of interface bytes, absent bytes are left out
+	   historical  : historical bytes
+	   tck         : check byte, None if there is none
+	   checksum_ok : False if TCK is wrong or missing
+	   fi, di      : FI / DI indexes from TA1
+	   f, d        : the matching Fi / Di values
+	   protocols   : list of the protocols offered, first one is the default
+	   extra_guard : extra guard time N from TC1, in etu
+	   specific    : True if the card runs a fixed mode (TA2 present), PPS
+	                 can't be used then
+	"""
+
+	def __init__(self, data):
+		data = bytes(data)
+		if atr_missing(data):
+			raise ProtocolError("Truncated ATR %s" % b2h(data))
+		self.raw = data
+		self.ts = data[0]
+		self.t0 = data[1]
+
+		self.interface = []
+		self.protocols = []
+		pos = 1
+		y = self.t0
+		while True:
+			group = {}
+			for i, name in enumerate(('ta', 'tb', 'tc', 'td')):
+				if y & (0x10 << i):
+					pos += 1
+					group[name] = data[pos]
+			self.interface.append(group)
+			if 'td' not in group:
+				break
+			y = group['td']
+			if (y & 0x0f) not in self.protocols:
+				self.protocols.append(y & 0x0f)
+		if not self.protocols:
+			self.protocols.append(0)
+
+		k = self.t0 & 0x0f
+		self.historical = data[pos + 1:pos + 1 + k]
+
+		# Some cards get it wrong, so it's only reported
+		if len(data) > pos + 1 + k:
+			self.tck = data[pos + 1 + k]
+			x = 0
+			for b in data[1:]:
+				x ^= b
+			self.checksum_ok = not x
+		else:
+			self.tck = None
+			self.checksum_ok = self.protocols == [0]
+
+		ta1 = self._byte(0, 'ta', DEFAULT_FIDI)
+		self.fi = ta1 >> 4
+		self.di = ta1 & 0x0f
+		self.f = FI_TABLE[self.fi]
+		self.d = DI_TABLE[self.di]
+		self.fmax = FMAX_TABLE[self.fi]
+		self.extra_guard = self._byte(0, 'tc', 0)
+		self.specific = self._byte(1, 'ta') is not None
+
+	def _byte(self, group, name, default=None):
+		if group < len(self.interface):
+			return self.interface[group].get(name, default)
+		return default
+
+	def __str__(self):
+		return b2h(self.raw)
+
+	def __repr__(self):
+		return 'Atr(%s)' % b2h(self.raw)
+
+	@property
+	def guard_time(self):
+		"""Character duration in etu, including the extra guard time. 255 is
+		   the minimum of 12 etu (11 in T=1)"""
+		if self.extra_guard == 255:
+			return 12 if self.protocols[0] == 0 else 11
+		return 12 + self.extra_guard
+
+	@property
+	def implicit_params(self):
+		"""In specific mode, whether the card runs at the default rate
+		   rather than at the one of TA1"""
+		return bool(self._byte(1, 'ta', 0) & 0x10)
+
+	def pps_params(self, rate, max_rate):
+		"""Picks the fastest FI / DI supported by the card giving an
+		   effective rate up to max_rate, for a link running at rate with
+		   the default parameters. Returns (fi, di, rate) or None if the
+		   default parameters are the best that can be done."""
+		if self.f is None or self.d is None or self.specific:
+			return None
+		best = None
+		for di, d in enumerate(DI_TABLE):
+			if d is None or d > self.d:
+				continue
+			r = rate * FI_TABLE[0] * d // self.f
+			if r <= max_rate and (best is None or r > best[2]):
+				best = (self.fi, di, r)
+		if best is None or best[2] <= rate:
+			return None
+		return best
+
+
+def pps_request(protocol, fi, di):
+	"""Builds a PPS request proposing FI / DI for protocol"""
+	pps = bytearray((0xff, 0x10 | protocol, (fi << 4) | di))
+	pck = 0
+	for b in pps:
+		pck ^= b
+	pps.append(pck)
+	return bytes(pps)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the APDU and SMS decoding paths
+
+Runs the card operations against the simulated card (or a replayed trace
+of a real session) and reports, for each of them, the APDU count, the bytes
+on the wire, the time they would take on a serial line and the CPU time
+spent on the host. Results are printed as JSON and can be compared to a
+stored baseline :
+
+    ./benchmark.py --save-baseline benchmark_baseline.json
+    ./benchmark.py --baseline benchmark_baseline.json
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from commands import SimCardCommands, FILE_MF, FILE_DF_TELECOM, FILE_EF_ADN
+from SimTrace import RecordingLink, ReplayLink
+from SimVirtual import VirtualSimLink, blank_card_image
+from SMSMessage import SMSmessage, decodeRecords
+
+
+# Metrics which don't depend on the machine, compared exactly
+EXACT_METRICS = ('apdus', 'bytes', 'wire_time')
+
+# CPU time differences below this (in seconds) are noise
+CPU_NOISE = 0.002
+
+
+def _pack7(text):
+    """Packs an ASCII text (letters, digits, spaces) into GSM 7-bit septets"""
+    bits = 0
+    n = 0
+    out = bytearray()
+    for c in text:
+        bits |= (ord(c) & 0x7f) << n
+        n += 7
+        while n >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            n -= 8
+    if n:
+        out.append(bits)
+    return out.hex()
+
+
+def sms_record(text, status='01'):
+    """Builds an EF_SMS record holding an SMS-DELIVER of text"""
+    pdu = status + '07911614910900f5' + '04' + '0b911614836816f1' + '00' + '00' + \
+        '02501070341400' + '%02x' % len(text) + _pack7(text)
+    return pdu + 'ff' * (176 - len(pdu) // 2)
+
+
+def adn_record(name, number):
+    alpha = name.encode().hex() + 'ff' * (14 - len(name))
+    digits = number + 'f' * (len(number) % 2)
+    bcd = ''.join(y + x for x, y in zip(digits[0::2], digits[1::2]))
+    return alpha + '%02x' % (len(bcd) // 2 + 1) + '81' + bcd + 'f' * (20 - len(bcd)) + 'ffff'
+
+
+def card_image(sms_count=30, sms_used=8, adn_count=100, adn_used=20):
+    """A card with a realistic share of empty records"""
+    step = sms_count // sms_used
+    sms = []
+    for i in range(sms_count):
+        if i % step == 0 and i // step < sms_used:
+            sms.append(sms_record('Message number %d sent to the benchmark card' % i))
+        else:
+            sms.append('00' + 'ff' * 175)
+    adn = [adn_record('Contact %d' % i, '0612345%03d' % i) for i in range(adn_used)]
+    return blank_card_image(sms=sms, adn=adn, sms_count=sms_count, adn_count=adn_count)
+
+
+def _measure(link, baudrate, fn, repeat):
+    """Runs fn(SimCardCommands) on a fresh card session and returns its
+    metrics, the CPU time is the best of repeat runs"""
+    cpu = None
+    for i in range(repeat):
+        rec = RecordingLink(link)
+        sc = SimCardCommands(rec)
+        sc.reset_card()
+        rec.reset_stats()
+        t = time.process_time()
+        fn(sc)
+        t = time.process_time() - t
+        cpu = t if cpu is None else min(cpu, t)
+    # Each APDU also carries one procedure byte, every character is 12 etu
+    wire_bytes = rec.bytes_tx + rec.bytes_rx
+    return {
+        'apdus': rec.apdu_count,
+        'bytes': wire_bytes,
+        'wire_time': round((wire_bytes + rec.apdu_count) * 12.0 / baudrate, 4),
+        'cpu_time': round(cpu, 6),
+    }
+
+
+def _decode_sms(records, count, repeat):
+    cpu = None
+    for r in range(repeat):
+        t = time.process_time()
+        for i in range(count):
+            s = SMSmessage()
+            s.smsFromData(records[i % len(records)])
+            # Fields are decoded on first access
+            s.status, s.number, s.time, s.message
+        t = time.process_time() - t
+        cpu = t if cpu is None else min(cpu, t)
+    return {'cpu_time': round(cpu, 6), 'pdus': count}
+
+
+def _decode_records(records, count, repeat):
+    dump = bytes.fromhex(''.join(records[i % len(records)] for i in range(count)))
+    cpu = None
+    for r in range(repeat):
+        t = time.process_time()
+        for i, s in decodeRecords(dump):
+            s.status, s.number, s.time, s.message
+        t = time.process_time() - t
+        cpu = t if cpu is None else min(cpu, t)
+    return {'cpu_time': round(cpu, 6), 'pdus': count}
+
+
+SCENARIOS = (
+    ('get_chv_info', lambda sc: sc.get_chv_info()),
+    ('get_sim_info', lambda sc: sc.get_sim_info()),
+    ('get_sms', lambda sc: sc.get_sms()),
+    ('get_sms_sparse', lambda sc: sc.get_sms(sparse=True)),
+    ('read_records_adn', lambda sc: sc.read_records([FILE_MF, FILE_DF_TELECOM, FILE_EF_ADN])),
+)
+
+
+def run(link, baudrate=9600, decode_count=10000, repeat=5):
+    results = {}
+    for name, fn in SCENARIOS:
+        try:
+            results[name] = _measure(link, baudrate, fn, repeat)
+        except Exception as e:
+            # ex. a replayed trace lacking the commands of this scenario
+            results[name] = {'error': str(e)}
+    records = [sms_record('Message number %d decoded by the benchmark' % i) for i in range(64)]
+    results['sms_from_data'] = _decode_sms(records, decode_count, repeat)
+    results['sms_decode_records'] = _decode_records(records, decode_count, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of regressions of results against baseline"""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if 'error' in metrics and 'error' not in base:
+            regressions.append('%s: %s' % (name, metrics['error']))
+        for k, v in sorted(metrics.items()):
+            if k not in base or k == 'error':
+                continue
+            if k in EXACT_METRICS:
+                limit = base[k]
+            else:
+                limit = max(base[k] * (1 + tolerance), base[k] + CPU_NOISE)
+            if v > limit:
+                regressions.append('%s.%s: %s -> %s' % (name, k, base[k], v))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--replay', metavar='TRACE',
+                        help='replay a trace recorded with RecordingLink instead of the simulated card')
+    parser.add_argument('--baudrate', type=int, default=9600, help='serial rate for the wire time')
+    parser.add_argument('--decode-count', type=int, default=10000, help='number of PDUs to decode')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the best CPU time is kept')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--save-baseline', metavar='FILE', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed CPU time increase over the baseline (default 0.25)')
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        link = ReplayLink(args.replay, strict=False)
+    else:
+        link = VirtualSimLink(card_image(), baudrate=args.baudrate)
+
+    results = run(link, args.baudrate, args.decode_count, args.repeat)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            sys.stderr.write('REGRESSION %s\n' % r)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,95 +46,440 @@ FILE_EF_ACC        = "6F78"
 FILE_EF_FPLMN      = "6F7B"
 FILE_EF_AD         = "6FAD"
 
+# Largest data field moved by one READ/UPDATE BINARY. P3=00 would mean 256
+# bytes for outgoing data but no data at all for a case 1 command, so the
+# transports treat it as the latter and 255 is the largest usable size.
+MAX_BINARY_CHUNK   = 255
+
+# TS 11.11 file types and EF structures, as coded in the SELECT response
+# Status words of a command sent to another file than meant : no EF selected,
+# file ID (or pattern) not found, file inconsistent with the command
+_STALE_SW = (0x9400, 0x9404, 0x9408)
+
+# Bytes on the line of locating one record with SEEK type 2 : SEEK header,
+# procedure byte and SW 9F01 (8 plus the pattern), then GET RESPONSE of the
+# record number with its procedure byte and SW (9)
+SEEK_RECORD_COST = 17
+# Bytes on the line of READ RECORD : header, procedure byte and SW (plus the
+# record)
+READ_RECORD_COST = 8
+
+# SELECT APDU of each file ID, built once
+_SELECT_APDUS = {}
+
+_FILE_TYPES = {0x01: 'mf', 0x02: 'df', 0x04: 'ef'}
+_EF_STRUCTURES = {0x00: 'transparent', 0x01: 'linear_fixed', 0x03: 'cyclic'}
+
+def _is_df(fid):
+	"""Tells if a file ID designates the MF or a DF (3Fxx / 7Fxx / 5Fxx)"""
+	return fid[0:2] in ('3f', '7f', '5f')
+
+
+def _parse_fcp(fcp):
+	"""Decodes the response to a SELECT (TS 11.11 section 9.2.1, bytes) into
+	a dict. For EFs, size, structure, record length / count and access
+	conditions are included, for the MF and DFs the free memory."""
+	info = {
+		'fid': b2h(fcp[4:6]),
+		'type': _FILE_TYPES.get(fcp[6], 'unknown') if len(fcp) > 6 else 'unknown',
+	}
+	if info['type'] != 'ef':
+		info['free'] = (fcp[2] << 8) | fcp[3]
+		return info
+
+	info['size'] = (fcp[2] << 8) | fcp[3]
+	info['access'] = b2h(fcp[8:11])
+	info['status'] = fcp[11]
+	info['structure'] = _EF_STRUCTURES.get(fcp[13], 'unknown')
+	if info['structure'] != 'transparent' and len(fcp) >= 15:
+		info['rec_len'] = fcp[14]
+	else:
+		info['rec_len'] = 0
+	info['rec_count'] = info['size'] // info['rec_len'] if info['rec_len'] else 0
+	return info
+
+
 class SimCardCommands(object):
 	def __init__(self, transport):
 		self._tp = transport;
-
-	def select_file(self, dir_list):
+		self._cur_path = None	# Absolute path of the current file, None if unknown
+		self._cur_fcp = None	# SELECT response (bytes) of the current file
+		self._fcp_cache = {}	# tuple(path) -> (SELECT response, parsed FCP)
+		self._occupancy = {}	# tuple(path) -> {pattern: set of empty record numbers}
+		self._iccid = None
+
+	def _invalidate_path(self):
+		self._cur_path = None
+		self._cur_fcp = None
+
+	def _invalidate_cache(self, path=None):
+		"""Drops the cached FCP of path, or of all files if path is None"""
+		if path is None:
+			self._fcp_cache.clear()
+			self._occupancy.clear()
+		else:
+			self._fcp_cache.pop(tuple(path), None)
+			self._occupancy.pop(tuple(path), None)
+
+	def _check_iccid(self, iccid):
+		"""Flushes everything known about the card if the ICCID changed"""
+		if self._iccid is not None and iccid != self._iccid:
+			self._invalidate_cache()
+		self._iccid = iccid
+
+	def _resolve_path(self, dir_list):
+		"""Returns the absolute path designated by dir_list, or None if it
+		can't be known (relative path while the current file is unknown)"""
+		path = [f.lower() for f in dir_list]
+		if path and path[0] == FILE_MF.lower():
+			return path
+		if self._cur_path is None or len(path) != 1 or _is_df(path[0]):
+			return None
+		# Single EF, relative to the current DF
+		cur_df = self._cur_path if _is_df(self._cur_path[-1]) else self._cur_path[:-1]
+		return cur_df + path
+
+	def _select_steps(self, path):
+		"""Returns the shortest list of SELECTs leading from the current file
+		to path, according to the selection rules of TS 11.11 section 6.5"""
+		cur = self._cur_path
+		if cur is None:
+			return path
+		if path == cur:
+			return []
+		cur_df = cur if _is_df(cur[-1]) else cur[:-1]
+		n = 0
+		while n < min(len(cur_df), len(path)) and cur_df[n] == path[n]:
+			n += 1
+		if n == len(cur_df):
+			# Below the current DF (or the current DF itself)
+			return path[n:] or path[-1:]
+		if n >= 1 and n == len(cur_df) - 1:
+			if len(path) > n and _is_df(path[n]):
+				# Sibling DF
+				return path[n:]
+			if n >= 2:
+				# Through the parent DF
+				return path[n - 1:]
+		return path
+
+	def _send_selects(self, steps):
 		rv = []
-		for i in dir_list:
-			data, sw = self._tp.send_apdu_checksw("a0a4000002" + i)
+		for i in steps:
+			apdu = _SELECT_APDUS.get(i)
+			if apdu is None:
+				apdu = _SELECT_APDUS[i] = b'\xa0\xa4\x00\x00\x02' + bytes(h2b(i))
+			data, sw = self._tp.send_apdu_checksw_bytes(apdu)
 			rv.append(data)
 		return rv
 
+	def select_file(self, dir_list):
+		return [b2h(fcp) for fcp in self._select(dir_list)]
+
+	def _select(self, dir_list):
+		"""select_file, returning the SELECT responses as bytes"""
+		if isinstance(dir_list, str):
+			dir_list = [dir_list]
+		path = self._resolve_path(dir_list)
+		if path is None:
+			# Unknown location, do it the dumb way
+			self._invalidate_path()
+			return self._send_selects(dir_list)
+
+		steps = self._select_steps(path)
+		if not steps:
+			return [self._cur_fcp]
+
+		try:
+			rv = self._send_selects(steps)
+		except RuntimeError:
+			self._invalidate_path()
+			if steps == path:
+				raise
+			# Our idea of the current file was wrong, start over from the MF
+			steps = path
+			rv = self._send_selects(path)
+
+		# Whatever the route, the i-th SELECT from the end lands on the
+		# i-th parent of path. What the card just answered wins over the
+		# cache, a different answer meaning the card was likely swapped
+		# behind our back, so nothing cached can be trusted any more.
+		base = len(path) - len(steps)
+		keys = [tuple(path[:base + i + 1]) for i in range(len(rv))]
+		for key, fcp in zip(keys, rv):
+			entry = self._fcp_cache.get(key)
+			if entry is not None and entry[0] != fcp:
+				self._invalidate_cache()
+				break
+		for key, fcp in zip(keys, rv):
+			self._fcp_cache[key] = (fcp, _parse_fcp(fcp))
+
+		self._cur_path = path
+		self._cur_fcp = rv[-1]
+		return rv
+
+	def file_info(self, ef):
+		"""Returns the parsed FCP of a file (see _parse_fcp). Cached files
+		cost no APDU at all, the others are selected."""
+		if isinstance(ef, str):
+			ef = [ef]
+		path = self._resolve_path(ef)
+		if path is not None:
+			entry = self._fcp_cache.get(tuple(path))
+			if entry is not None:
+				return entry[1]
+		return self._select_info(ef)
+
+	def _select_info(self, ef):
+		"""Selects a file and returns its parsed FCP"""
+		r = self._select(ef)
+		if self._cur_path is None:
+			return _parse_fcp(r[-1])
+		key = tuple(self._cur_path)
+		entry = self._fcp_cache.get(key)
+		if entry is None:
+			entry = self._fcp_cache[key] = (r[-1], _parse_fcp(r[-1]))
+		return entry[1]
+
+	def _send_on_ef(self, pdu, check=False, stale=_STALE_SW):
+		"""Sends pdu acting on the EF just selected. Its SELECTs are skipped
+		when the card should still be on it, so if the card answers as if it
+		wasn't (ex. it was reset through the link since), the EF is selected
+		again from the MF and pdu sent once more.
+
+		   check  : raise RuntimeError unless the SW is 9000
+		   return : tuple(data, sw) as for send_apdu_bytes
+		"""
+		path = self._cur_path
+		data, sw = self._tp.send_apdu_bytes(pdu)
+		if sw in stale and path is not None:
+			self._invalidate_path()
+			self._select(path)
+			data, sw = self._tp.send_apdu_bytes(pdu)
+		if check and sw != 0x9000:
+			raise RuntimeError("SW match failed ! Expected 9000 and got %s." %
+				(sw if sw is None else '%04x' % sw))
+		return data, sw
+
 	def status(self):
-		data, sw = self._tp.send_apdu_checksw("a0f200000D")
-		len = int("0D", 16) + int(data[24:26], 16)
-		data, sw = self._tp.send_apdu_checksw("a0f20000" + ('%02x' % len))
+		return b2h(self._status())
+
+	def _status(self):
+		data, sw = self._tp.send_apdu_checksw_bytes(b'\xa0\xf2\x00\x00\x0d')
+		len = 0x0d + data[12]
+		data, sw = self._tp.send_apdu_checksw_bytes(bytes((0xa0, 0xf2, 0x00, 0x00, len)))
 		return data
 
 
-	def read_binary(self, ef, length=None, offset=0):
+	def read_binary(self, ef, length=None, offset=0, progress=None, raw=False):
+		"""Reads length bytes (default: up to the end of the file) of a
+		transparent EF, in as few READ BINARY as possible.
+
+		   progress : optional callable(done, total) called after each chunk
+		   raw      : if True, data is returned as bytes and sw as an int
+		   return   : tuple(data, sw) of the whole read, reading stops at the
+		              first chunk not ending with 9000
+		"""
 		if not hasattr(type(ef), '__iter__'):
 			ef = [ef]
-		r = self.select_file(ef)
+		info = self._select_info(ef)
 		if length is None:
-			length = int(r[-1][4:8], 16) - offset
-		pdu = 'a0b0%04x%02x' % (offset, (min(256, length) & 0xff))
-		return self._tp.send_apdu(pdu)
-
-	def update_binary(self, ef, data, offset=0):
+			length = info['size'] - offset
+		if length <= 0:
+			# P3=00 would ask a T=0 card for 256 bytes
+			return (b'', 0x9000) if raw else ('', '9000')
+		chunks = []
+		done = 0
+		while True:
+			chunk = min(MAX_BINARY_CHUNK, length - done)
+			pos = offset + done
+			data, sw = self._send_on_ef(bytes((0xa0, 0xb0, pos >> 8, pos & 0xff, chunk)))
+			if data:
+				chunks.append(data)
+			if sw != 0x9000:
+				break
+			done += chunk
+			if progress:
+				progress(done, length)
+			if done >= length:
+				break
+		data = b''.join(chunks)
+		if raw:
+			return data, sw
+		return b2h(data), None if sw is None else '%04x' % sw
+
+	def update_binary(self, ef, data, offset=0, progress=None):
+		"""Writes data (hex) to a transparent EF at offset, in as few UPDATE
+		BINARY as possible.
+
+		   progress : optional callable(done, total) called after each chunk
+		"""
 		if not hasattr(type(ef), '__iter__'):
 			ef = [ef]
-		self.select_file(ef)
-		pdu = 'a0d6%04x%02x' % (offset, len(data)/2) + data
-		return self._tp.send_apdu_checksw(pdu)
-
-	def read_records(self, ef):
-		if not hasattr(type(ef), '__iter__'):
+		data = h2b(data)
+		if not data:
+			return '', '9000'
+		self._select(ef)
+		self._invalidate_cache(self._cur_path)
+		length = len(data)
+		done = 0
+		while True:
+			chunk = min(MAX_BINARY_CHUNK, length - done)
+			pos = offset + done
+			pdu = bytes((0xa0, 0xd6, pos >> 8, pos & 0xff, chunk)) + data[done:done + chunk]
+			rv = self._send_on_ef(pdu, check=True)
+			done += chunk
+			if progress:
+				progress(done, length)
+			if done >= length:
+				return b2h(rv[0]), '%04x' % rv[1]
+
+	def seek_records(self, ef, pattern):
+		"""Returns the numbers of all records starting with pattern, found
+		with SEEK type 2 (TS 11.11 section 9.2.6), or None if the card
+		doesn't support it."""
+		self._select(ef)
+		pattern = h2b(pattern)
+		found = []
+		mode = 0x10	# From the beginning forward, then from the next location
+		while True:
+			pdu = bytes((0xa0, 0xa2, 0x00, mode, len(pattern))) + pattern
+			# 9404 is the normal end of the search here
+			data, sw = self._send_on_ef(pdu, stale=(0x9400, 0x9408))
+			if sw == 0x9404:	# Pattern not found
+				break
+			if sw != 0x9000 or not data:
+				return None
+			rec_no = data[0]
+			if found and rec_no <= found[-1]:
+				break
+			found.append(rec_no)
+			mode = 0x12
+		return found
+
+	def _empty_records(self, ef, pattern):
+		"""Returns the set of records of ef starting with pattern, from the
+		occupancy cache or by SEEKing them. None if it can't be known."""
+		rec_length = self._select_info(ef)['rec_len']
+		if self._cur_path is None:
+			return None
+		cached = self._occupancy.setdefault(tuple(self._cur_path), {})
+		if pattern not in cached:
+			# Each empty record found by SEEK saves reading it, the other
+			# records are read either way. Not worth it when the pattern is
+			# about as long as the record (ex. all 'ff' for EF_ADN), the
+			# occupancy is then found by the full read.
+			if len(pattern) // 2 + SEEK_RECORD_COST >= rec_length + READ_RECORD_COST:
+				return None
+			found = self.seek_records(ef, pattern)
+			if found is None:
+				return None
+			cached[pattern] = set(found)
+		return cached[pattern]
+
+	def iter_records(self, ef, start=1, stop=None, step=1, sparse=None, raw=False):
+		"""Reads the records of a linear fixed EF one by one, yielding a
+		tuple(rec_no, data, sw) as soon as each READ RECORD completes.
+
+		   start, stop, step : record numbers to read, as for range() (stop
+		                       excluded, default is up to the last record)
+		   sparse            : hex pattern the empty records start with
+		                       (ex. "00" for EF_SMS). Empty records are located
+		                       first and not read, they are yielded as the
+		                       pattern padded with 'ff' and a None sw.
+		                       Meant for EF_SMS : each empty record found costs
+		                       a SEEK and a GET RESPONSE instead of a READ
+		                       RECORD, more APDUs but far fewer bytes on the
+		                       line. With a pattern about as long as the
+		                       records nothing is SEEKed, see _empty_records.
+		   raw               : if True, data is yielded as bytes and sw as an
+		                       int
+		"""
+		if isinstance(ef, str):
 			ef = [ef]
-		r = self.select_file(ef)
-		rec_length = int(r[-1][28:30], 16)
-		num_of_records = int(r[-1][4:8], 16) // rec_length
-
-		all_data = []
-		for i in range(1, num_of_records + 1):
-			pdu = 'a0b2%02x04%02x' % (i, rec_length)
-			data, sw = self._tp.send_apdu(pdu)
-			all_data.append(data)
-
-		return all_data
-
-	def read_record(self, ef, rec_no):
+		info = self._select_info(ef)
+		path = self._cur_path
+		rec_length = info['rec_len']
+		last = info['rec_count'] + 1
+		stop = last if stop is None else min(stop, last)
+
+		empty = None
+		found = None
+		if sparse:
+			sparse = sparse.lower()
+			prefix = bytes(h2b(sparse))
+			filler = prefix + b'\xff' * (rec_length - len(prefix))
+			if not raw:
+				filler = b2h(filler)
+			empty = self._empty_records(ef, sparse)
+			if empty is None and path is not None and (start, stop, step) == (1, last, 1):
+				# No SEEK, remember what a full read finds for the next time
+				found = set()
+
+		for i in range(start, stop, step):
+			if empty is not None and i in empty:
+				yield i, filler, None
+				continue
+			# The caller may have used the card in between
+			if path is not None and self._cur_path != path:
+				self._select(path)
+			data, sw = self._send_on_ef(bytes((0xa0, 0xb2, i, 0x04, rec_length)))
+			if found is not None and data and data.startswith(prefix):
+				found.add(i)
+			if raw:
+				yield i, data, sw
+			else:
+				yield i, None if data is None else b2h(data), None if sw is None else '%04x' % sw
+
+		if found is not None:
+			self._occupancy.setdefault(tuple(path), {})[sparse] = found
+
+	def read_records(self, ef, sparse=None, raw=False):
+		return [data for i, data, sw in self.iter_records(ef, sparse=sparse, raw=raw)]
+
+	def read_record(self, ef, rec_no, raw=False):
 		if not hasattr(type(ef), '__iter__'):
 			ef = [ef]
-		r = self.select_file(ef)
-		rec_length = int(r[-1][28:30], 16)
-		pdu = 'a0b2%02x04%02x' % (rec_no, rec_length)
-		return self._tp.send_apdu(pdu)
+		rec_length = self._select_info(ef)['rec_len']
+		data, sw = self._send_on_ef(bytes((0xa0, 0xb2, rec_no, 0x04, rec_length)))
+		if raw:
+			return data, sw
+		return None if data is None else b2h(data), None if sw is None else '%04x' % sw
 
 	def update_record(self, ef, rec_no, data, force_len=False):
 		if not hasattr(type(ef), '__iter__'):
 			ef = [ef]
-		r = self.select_file(ef)
+		info = self._select_info(ef)
+		self._invalidate_cache(self._cur_path)
 		if not force_len:
-			rec_length = int(r[-1][28:30], 16)
-			if (len(data)/2 != rec_length):
-				raise ValueError('Invalid data length (expected %d, got %d)' % (rec_length, len(data)/2))
+			rec_length = info['rec_len']
+			if (len(data)//2 != rec_length):
+				raise ValueError('Invalid data length (expected %d, got %d)' % (rec_length, len(data)//2))
 		else:
-			rec_length = len(data)/2
-		pdu = ('a0dc%02x04%02x' % (rec_no, rec_length)) + data
-		return self._tp.send_apdu_checksw(pdu)
+			rec_length = len(data)//2
+		pdu = bytes((0xa0, 0xdc, rec_no, 0x04, rec_length)) + h2b(data)
+		data, sw = self._send_on_ef(pdu, check=True)
+		return b2h(data), '%04x' % sw
 
 	def record_size(self, ef):
-		r = self.select_file(ef)
-		return int(r[-1][28:30], 16)
+		return self.file_info(ef)['rec_len']
 
 	def record_count(self, ef):
-		r = self.select_file(ef)
-		return int(r[-1][4:8], 16) // int(r[-1][28:30], 16)
+		return self.file_info(ef)['rec_count']
 
 	def run_gsm(self, rand):
 		if len(rand) != 32:
 			raise ValueError('Invalid rand')
-		self.select_file(['3f00', '7f20'])
+		self._select(['3f00', '7f20'])
 		return self._tp.send_apdu('a088000010' + rand)
 
 	def reset_card(self):
+		self._invalidate_path()
+		self._invalidate_cache()
 		return self._tp.reset_card()
 
 	def verify_chv(self, chv_no, code):
-		self.select_file(['3f00', '7f20'])
+		self._select(['3f00', '7f20'])
 		fc = rpad(b2h(code.encode()), 16)
 		return self._tp.send_apdu_checksw('a02000' + ('%02x' % chv_no) + '08' + fc)
 
@@ -143,7 +488,7 @@ class SimCardCommands(object):
 		return self._tp.send_apdu_checksw('a026000108' + fc)
 
 	def enable_chv(self, code):
-		self.select_file(['3f00', '7f20', '6f38'])
+		self._select(['3f00', '7f20', '6f38'])
 		fc = rpad(b2h(code.encode()), 16)
 		return self._tp.send_apdu_checksw("a028000108" + fc)
 
@@ -152,55 +497,56 @@ class SimCardCommands(object):
 		return self._tp.send_apdu_checksw("a02400" + ('%02x' % chv_no) + "10" + fc)
 
 	def unblock_chv(self, chv_no, code):
-		self.select_file(['3f00', '7f20', '6f38'])
+		self._select(['3f00', '7f20', '6f38'])
 		fc = rpad(b2h(code.encode()), 16)
 		if chv_no == 1:
 			chv_no = 0
 		return self._tp.send_apdu_checksw("a02c00" + ('%02x' % chv_no) + "10" + fc)
 
 	def get_chv_info(self):
-		self.select_file([FILE_MF])
+		self._select([FILE_MF])
 		chv1_enabled = 1
 		chv1_tries_left = 3
 		chv2_enabled = 1
 		chv2_tries_left = 3
 
-		response = self.status()
-		status_data = response[26:]
-		file_characteristic = status_data[:2]
-		if int(file_characteristic, 16) & 0x80:
+		response = self._status()
+		status_data = response[13:]
+		file_characteristic = status_data[0]
+		if file_characteristic & 0x80:
 			chv1_enabled = 0
-		ch1_status = status_data[10:12]
-		chv1_tries_left = int(ch1_status, 16) & 0x0F
+		ch1_status = status_data[5]
+		chv1_tries_left = ch1_status & 0x0F
 
-		if len(status_data) >= 18:
+		if len(status_data) >= 9:
 			# Get number of CHV2 attempts left (0 means blocked, oh crap!)
 			chv2_enabled = 1
-			chv2_status = status_data[14:16]
-			chv2_tries_left = int(chv2_status, 16) & 0x0F
+			chv2_status = status_data[7]
+			chv2_tries_left = chv2_status & 0x0F
 
 		return chv1_enabled, chv1_tries_left, chv2_enabled, chv2_tries_left
 
+	def get_iccid(self):
+		data, sw = self.read_binary([FILE_MF, FILE_EF_ICCID], 10)
+		iccid = swap_nibbles(data)
+		iccid = iccid.replace('f', '')
+		self._check_iccid(iccid)
+		return iccid
+
 	def get_sim_info(self):
-		self.select_file([FILE_MF, FILE_DF_GSM])
-		data, sw = self.read_binary([FILE_EF_LOCI], 5, 4)
+		data, sw = self.read_binary([FILE_MF, FILE_DF_GSM, FILE_EF_LOCI], 5, 4)
 		location = swap_nibbles(data)
 
 		response = self.select_file([FILE_MF, FILE_DF_TELECOM, FILE_EF_MSISDN])
 		msisdn = response[-1]
 
-		self.select_file([FILE_MF])
-		data, sw = self.read_binary([FILE_EF_ICCID], 10)
-		iccid = swap_nibbles(data)
-		iccid = iccid.replace('f', '')
+		iccid = self.get_iccid()
 
-		self.select_file([FILE_MF, FILE_DF_GSM])
-		data, sw = self.read_binary([FILE_EF_IMSI], 9)
+		data, sw = self.read_binary([FILE_MF, FILE_DF_GSM, FILE_EF_IMSI], 9)
 		leng = int(data[:2], 16)
 		imsi = swap_nibbles(data[2:])[:(leng*2)]
 
-		self.select_file([FILE_MF, FILE_DF_GSM])
-		data, sw = self.read_binary([FILE_EF_PHASE], 1)
+		data, sw = self.read_binary([FILE_MF, FILE_DF_GSM, FILE_EF_PHASE], 1)
 		if data == "00":
 			phase = 'Phase 1'
 		elif data == "02":
@@ -212,7 +558,21 @@ class SimCardCommands(object):
 
 		return location, msisdn, imsi, iccid, phase
 
-	def get_sms(self):
-		self.select_file([FILE_MF, FILE_DF_TELECOM])
-		records = self.read_records([FILE_EF_SMS])
-		return records
\ No newline at end of file
+	def get_sms(self, sparse=False):
+		"""Reads EF_SMS, with sparse the free records (status 00) aren't
+		read but SEEKed, see iter_records"""
+		records = self.read_records([FILE_MF, FILE_DF_TELECOM, FILE_EF_SMS],
+			sparse='00' if sparse else None)
+		return records
+
+	def iter_sms(self, start=1, stop=None, sparse=False, raw=False):
+		return self.iter_records([FILE_MF, FILE_DF_TELECOM, FILE_EF_SMS], start, stop,
+			sparse='00' if sparse else None, raw=raw)
+
+	def sms_count(self):
+		return self.record_count([FILE_MF, FILE_DF_TELECOM, FILE_EF_SMS])
+
+	def get_adn(self):
+		# No sparse read, an empty ADN record is all 'ff' and SEEKing it
+		# would cost more than reading it
+		return self.read_records([FILE_MF, FILE_DF_TELECOM, FILE_EF_ADN])
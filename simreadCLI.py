@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Dumps a SIM card to JSON, without any GUI
+
+Connects to a serial reader, waits for the card, verifies CHV1 if needed
+and writes the SIM info, contacts and SMS to stdout :
+
+    ./simreadCLI.py --device /dev/ttyUSB0 --pin 1234 > card.json
+    SIMREAD_PIN=1234 ./simreadCLI.py --device /dev/ttyUSB1 --format ndjson
+
+With --format ndjson, each section, contact and SMS is one JSON object per
+line, written as soon as it's read. Exit status is 1 if no card showed up or
+the card couldn't be read.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from commands import SimCardCommands
+from exceptions import NoCardError, ProtocolError
+from ReaderPool import iter_card, read_card
+from SimSerial import SerialSimLink
+
+
+def open_link(args):
+    card_image = os.environ.get('SIMREAD_CARD_IMAGE')
+    if card_image:
+        # Simulated card, for testing without a reader
+        from SimVirtual import VirtualSimLink, load_card_image
+        return 'virtual', VirtualSimLink(load_card_image(card_image))
+
+    sl = SerialSimLink()
+    device = args.device
+    if device is None:
+        ports = sl.scan_serial_ports()
+        if not ports:
+            raise EnvironmentError('No available serial ports')
+        device = ports[0]
+    sl.connect(device, args.baudrate, max_baudrate=args.max_baudrate)
+    return device, sl
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--device', help='serial port of the reader (default: first one found)')
+    parser.add_argument('--pin', default=os.environ.get('SIMREAD_PIN'),
+                        help='CHV1 to verify if enabled (default: $SIMREAD_PIN)')
+    parser.add_argument('--format', choices=('json', 'ndjson'), default='json', help='output format')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for a card')
+    parser.add_argument('--baudrate', type=int, default=9600, help='rate of the reader')
+    parser.add_argument('--max-baudrate', type=int,
+                        help='negotiate a faster rate with the card, up to this one')
+    args = parser.parse_args(argv)
+
+    try:
+        device, sl = open_link(args)
+        sl.wait_for_card(timeout=args.timeout)
+    except NoCardError:
+        sys.stderr.write('No card inserted\n')
+        return 1
+    except (EnvironmentError, ProtocolError) as e:
+        sys.stderr.write('Reader error: %s\n' % e)
+        return 1
+
+    sc = SimCardCommands(sl)
+    out = sys.stdout
+    try:
+        if args.format == 'ndjson':
+            for section, item in iter_card(sc, args.pin):
+                line = {'device': device, 'section': section}
+                line.update(item)
+                out.write(json.dumps(line, sort_keys=True) + '\n')
+                out.flush()
+        else:
+            rv = read_card(sc, args.pin)
+            rv['device'] = device
+            json.dump(rv, out, indent=2, sort_keys=True)
+            out.write('\n')
+    except (RuntimeError, ProtocolError, NoCardError, ValueError) as e:
+        sys.stderr.write('Card error: %s\n' % e)
+        return 1
+    finally:
+        sl.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,24 +4,196 @@ __license__ = "GNU"
 __version__ = "1.0.0"
 
 # from test_pySIMlib import pySIMlib
-import sys, time
-from PyQt5.QtWidgets import QMainWindow, QFrame, QGridLayout, QVBoxLayout, QDesktopWidget, QApplication, QDialog, QLabel, QWidget, QPushButton, QInputDialog, QFormLayout, QLineEdit, QDialogButtonBox, QMessageBox
-from PyQt5.QtCore import QCoreApplication, Qt, QBasicTimer, pyqtSignal, QRect
-from PyQt5.QtGui import QPainter, QColor, QFont
-from SimSerial import SerialSimLink
-from commands import SimCardCommands
-from utils import swap_nibbles
-from SMSMessage import SMSmessage
+import os, sys, time
+_START = time.perf_counter()
+
+import importlib
+import queue
+import threading
+from PyQt5.QtWidgets import QMainWindow, QGridLayout, QApplication, QDialog, QWidget, QPushButton, QInputDialog, QFormLayout, QLineEdit, QDialogButtonBox, QMessageBox, QProgressDialog
+from PyQt5.QtCore import QCoreApplication, Qt, QThread, pyqtSignal
 from traceback import print_exc
 
+# The card stack (SimSerial and pyserial, commands, SMSMessage and its
+# codec tables) is only imported by the card worker, so that the window
+# shows up first. Set SIMREAD_IMPORT_TIMES=1 to get the time of each step
+# on stderr.
+IMPORT_TIMES = bool(os.environ.get('SIMREAD_IMPORT_TIMES'))
+
+
+def log_time(label, since=_START):
+    if IMPORT_TIMES:
+        sys.stderr.write("%s: %.1f ms\n" % (label, (time.perf_counter() - since) * 1000))
+
+
+def load(name):
+    """Imports a module on first use"""
+    module = sys.modules.get(name)
+    if module is None:
+        t = time.perf_counter()
+        module = importlib.import_module(name)
+        log_time("import " + name, t)
+    return module
+
+
+log_time("import Qt")
+
+
+class CardWorker(QThread):
+    """Owns the reader and runs the card operations off the GUI thread.
+
+    Jobs are queued with submit() and run one after the other. A job is a
+    callable taking the worker as first argument, its return value comes
+    back through the result signal, its exception through failed. Long jobs
+    report through progress() and stop early once cancelled() is set.
+    """
+
+    progressed = pyqtSignal(str, int, int)
+    result = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._jobs = queue.Queue()
+        self._cancel = threading.Event()
+        self._current = None
+        self.sl = None
+        self.sc = None
+
+    def submit(self, name, job, *args):
+        # Cleared here rather than in run(), so a cancel requested while
+        # the job is still queued is not lost
+        self._cancel.clear()
+        self._jobs.put((name, job, args))
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def progress(self, done, total):
+        self.progressed.emit(self._current, done, total)
+
+    def stop(self):
+        self.cancel()
+        self._jobs.put(None)
+        self.wait()
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            name, fn, args = job
+            self._current = name
+            try:
+                rv = fn(self, *args)
+            except Exception as e:
+                print_exc()
+                self.failed.emit(name, str(e))
+            else:
+                self.result.emit(name, rv)
+
+
+# Card jobs, run by the CardWorker
+
+def preload_job(w):
+    """Loads the card stack while the user looks at the window"""
+    for name in ('SimSerial', 'commands', 'SMSMessage'):
+        load(name)
+
+
+def scan_job(w):
+    card_image = os.environ.get('SIMREAD_CARD_IMAGE')
+    if card_image:
+        # Simulated card, for testing without a reader
+        SimVirtual = load('SimVirtual')
+        w.sl = SimVirtual.VirtualSimLink(SimVirtual.load_card_image(card_image))
+        return None
+    w.sl = load('SimSerial').SerialSimLink(debug=True)
+    return w.sl.scan_serial_ports()
+
+
+def connect_job(w, port):
+    NoCardError = load('exceptions').NoCardError
+    if port is not None:
+        w.sl.connect(port, 9600)
+
+    # ac = AppLoaderCommands(sl)
+
+    while True:
+        try:
+            w.sl.wait_for_card(timeout=1)
+            break
+        except NoCardError:
+            if w.cancelled():
+                return None
+    time.sleep(0.5)
+    w.sc = load('commands').SimCardCommands(w.sl)
+    return w.sc.get_chv_info()
+
+
+def verify_pin_job(w, pin):
+    return w.sc.verify_chv(1, pin)
+
+
+def sim_info_job(w):
+    return w.sc.get_chv_info(), w.sc.get_sim_info()
+
+
+def change_pin_job(w, curr_pin, new_pin):
+    data1 = w.sc.verify_chv(1, curr_pin)
+    data2 = w.sc.change_chv(1, curr_pin, new_pin)
+    return data1, data2
+
+
+def disable_pin_job(w, pin):
+    return w.sc.disable_chv(pin)
+
+
+def enable_pin_job(w, pin):
+    return w.sc.enable_chv(pin)
+
+
+def sms_job(w):
+    SMSMessage = load('SMSMessage')
+    messages = []
+    total = w.sc.sms_count()
+    for rec_no, sms, sw in w.sc.iter_sms(sparse=True, raw=True):
+        s = SMSMessage.SMSmessage()
+        s.smsFromData(sms)
+        if s.message:
+            messages.append((rec_no, s))
+        w.progress(rec_no, total)
+        if w.cancelled():
+            break
+
+    lines = ""
+    for s, segments, missing in SMSMessage.reassembleMessages(messages):
+        line = "Timestamp: " + s.timestamp + "From: " + s.number + "Status: " + s.status + "Message: " + s.message
+        if missing:
+            line += " [missing parts " + ", ".join(str(i) for i in missing) + "]"
+        lines += line + "\n"
+    return lines
+
 
 class SIMReadGUI(QMainWindow):
     def __init__(self):
         super().__init__()
 
         # self.SIMReader = pySIMlib(True)
+        self.worker = CardWorker(self)
+        self.worker.result.connect(self.job_done)
+        self.worker.failed.connect(self.job_failed)
+        self.worker.progressed.connect(self.job_progress)
+        self.worker.start()
+        self.progress_dialog = None
+
         self.initUI()
-        self.sl = None
+        self.connected = False
+        log_time("window shown")
+        self.worker.submit('preload', preload_job)
 
     def initUI(self):
 
@@ -86,19 +258,62 @@ class SIMReadGUI(QMainWindow):
     def send_terminal_profile(self, _tp):
         return _tp.send_apdu_checksw('A010000011FFFF000000000000000000000000000000')
 
-    def get_sim_info(self):
-        if not self.sl:
-            self.connect_reader()
-
-        sc = SimCardCommands(self.sl)
-        try:
-            chv_info = sc.get_chv_info()
-            sim_info = sc.get_sim_info()
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
+    # Worker plumbing
+
+    def run_job(self, name, job, *args, busy_text=None):
+        """Queues a job on the card worker, with a cancellable progress
+        dialog if busy_text is given"""
+        self.set_busy(True)
+        if busy_text:
+            self.progress_dialog = QProgressDialog(busy_text, "Cancel", 0, 0, self)
+            self.progress_dialog.setWindowModality(Qt.WindowModal)
+            self.progress_dialog.setMinimumDuration(0)
+            self.progress_dialog.canceled.connect(self.worker.cancel)
+            self.progress_dialog.show()
+        self.worker.submit(name, job, *args)
+
+    def end_job(self):
+        if self.progress_dialog:
+            self.progress_dialog.close()
+            self.progress_dialog = None
+        self.set_busy(False)
+
+    def job_progress(self, name, done, total):
+        if self.progress_dialog:
+            self.progress_dialog.setMaximum(total)
+            self.progress_dialog.setValue(done)
+
+    def job_failed(self, name, error):
+        if name == 'preload':
+            return  # Not started by the user, the next job will tell
+        self.end_job()
+        self.show_error_dialog(error)
+
+    def job_done(self, name, rv):
+        if name == 'preload':
+            log_time("card stack loaded")
             return
+        self.end_job()
+        handler = getattr(self, 'on_' + name, None)
+        if handler:
+            handler(rv)
+
+    def set_busy(self, busy):
+        self.connect_button.setEnabled(not busy)
+        for b in self.card_buttons():
+            b.setEnabled(self.connected and not busy)
 
+    def card_buttons(self):
+        return (self.sim_info_button, self.changePinButton, self.enablePinButton,
+                self.disablePinButton, self.smsButton)
+
+    # Actions
+
+    def get_sim_info(self):
+        self.run_job('sim_info', sim_info_job)
+
+    def on_sim_info(self, rv):
+        chv_info, sim_info = rv
         self.show_info(chv_info, sim_info)
 
     def show_info(self, chv_info, sim_info):
@@ -120,31 +335,28 @@ class SIMReadGUI(QMainWindow):
         print("value of pressed message box button:", retval)
 
     def connect_reader(self):
-
-        self.sl = SerialSimLink(debug=True)
-        ports = self.sl.scan_serial_ports()
-        if not ports:
-            raise Exception("No available serial ports.")
+        self.connected = False
+        self.run_job('scan', scan_job, busy_text="Looking for readers...")
+
+    def on_scan(self, ports):
+        if ports is None:
+            # Simulated reader, nothing to choose
+            selected_port = None
+        elif not ports:
+            self.show_error_dialog("No available serial ports.")
+            return
         elif len(ports) < 2:
             selected_port = ports[0]
         else:
             selected_port = self.select_port(ports)
+            if not selected_port:
+                return
 
-        if not selected_port:
-            return
-
-        self.sl.connect(selected_port, 9600)
-
-        # ac = AppLoaderCommands(sl)
+        self.run_job('connect', connect_job, selected_port, busy_text="Waiting for card...")
 
-        self.sl.wait_for_card()
-        time.sleep(0.5)
-        sc = SimCardCommands(self.sl)
-        try:
-            chv_info = sc.get_chv_info()
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
+    def on_connect(self, chv_info):
+        if chv_info is None:
+            # Cancelled while waiting for the card
             return
 
         if chv_info[0]:
@@ -153,18 +365,13 @@ class SIMReadGUI(QMainWindow):
                 self.show_error_dialog("PIN is not valid.")
                 return
 
-            try:
-                sc.verify_chv(1, pin)
-            except Exception as e:
-                print_exc()
-                self.show_error_dialog(str(e))
-                return
+            self.run_job('verify_pin', verify_pin_job, pin)
+        else:
+            self.on_verify_pin(None)
 
-        self.smsButton.setEnabled(True)
-        self.changePinButton.setEnabled(True)
-        self.disablePinButton.setEnabled(True)
-        self.enablePinButton.setEnabled(True)
-        self.sim_info_button.setEnabled(True)
+    def on_verify_pin(self, rv):
+        self.connected = True
+        self.set_busy(False)
         # self.connect_button.setEnabled(False)
 
     def show_error_dialog(self, text):
@@ -194,7 +401,10 @@ class SIMReadGUI(QMainWindow):
 
     def change_pin(self):
 
-        curr_pin, new_pin = self.enter_new_pin()
+        pins = self.enter_new_pin()
+        if not pins:
+            return
+        curr_pin, new_pin = pins
 
         if not curr_pin or not curr_pin.isdigit() or len(curr_pin) < 4 or len(curr_pin) > 8:
             return
@@ -202,23 +412,14 @@ class SIMReadGUI(QMainWindow):
         if not new_pin or not new_pin.isdigit() or len(new_pin) < 4 or len(new_pin) > 8:
             return
 
-        if not self.sl:
-            self.connect_reader()
-
-        sc = SimCardCommands(self.sl)
-
-        try:
-            data1 = sc.verify_chv(1, curr_pin)
-            data2 = sc.change_chv(1, curr_pin, new_pin)
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
-            return
+        self.run_job('change_pin', change_pin_job, curr_pin, new_pin)
 
+    def on_change_pin(self, rv):
         self.disable_buttons()
-        print("Changed!:" + str(data1) + str(data2))
+        print("Changed!:" + str(rv[0]) + str(rv[1]))
 
     def disable_buttons(self):
+        self.connected = False
         self.sim_info_button.setEnabled(False)
         self.changePinButton.setEnabled(False)
         self.enablePinButton.setEnabled(False)
@@ -230,39 +431,20 @@ class SIMReadGUI(QMainWindow):
         pin = self.enter_pin()
         if not pin or not pin.isdigit() or len(pin) < 4 or len(pin) > 8:
             return
-        if not self.sl:
-            self.connect_reader()
-
-        sc = SimCardCommands(self.sl)
-
-        try:
-            sc.disable_chv(pin)
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
-            return
+        self.run_job('disable_pin', disable_pin_job, pin)
 
+    def on_disable_pin(self, rv):
         self.disable_buttons()
 
     def enable_pin(self):
         pin = self.enter_pin()
         if not pin or not pin.isdigit() or len(pin) < 4 or len(pin) > 8:
             return
-        if not self.sl:
-            self.connect_reader()
-
-        sc = SimCardCommands(self.sl)
-
-        try:
-            sc.enable_chv(pin)
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
-            return
+        self.run_job('enable_pin', enable_pin_job, pin)
 
+    def on_enable_pin(self, rv):
         self.disable_buttons()
 
-
     def enter_new_pin(self):
         dialog = InputDialog()
         if dialog.exec():
@@ -270,26 +452,9 @@ class SIMReadGUI(QMainWindow):
         return None
 
     def get_sms(self):
-        if not self.sl:
-            self.connect_reader()
-
-        sc = SimCardCommands(self.sl)
-
-        try:
-            all_sms = sc.get_sms()
-        except Exception as e:
-            print_exc()
-            self.show_error_dialog(str(e))
-            return
-
-        lines = ""
-        for sms in all_sms:
-            s = SMSmessage()
-            s.smsFromData(sms)
-            if s.message:
-                line = "Timestamp: " + s.timestamp + "From: " + s.number + "Status: " + s.status + "Message: " + s.message + "\n"
-                lines += line
+        self.run_job('sms', sms_job, busy_text="Reading messages...")
 
+    def on_sms(self, lines):
         msg = QMessageBox()
         # msg.setIcon(QMessageBox.Information)
         if not lines:
@@ -302,11 +467,14 @@ class SIMReadGUI(QMainWindow):
         print("value of pressed message box button:", retval)
 
     def exit(self):
-        if self.SIMReader.state:
-            self.SIMReader.closeSession()
+        self.worker.stop()
 
         QCoreApplication.instance().quit()
 
+    def closeEvent(self, event):
+        self.worker.stop()
+        super().closeEvent(event)
+
 class InputDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -333,4 +501,4 @@ if __name__ == '__main__':
     app.setStyle('Fusion')
 
     window = SIMReadGUI()
-    app.exec_()
\ No newline at end of file
+    app.exec_()
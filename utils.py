@@ -24,20 +24,19 @@
 
 def h2b(s):
 	# return ''.join([chr((int(x,16)<<4)+int(y,16)) for x,y in zip(s[0::2], s[1::2])])
-	b = bytearray()
-	for x, y in zip(s[0::2], s[1::2]):
-		b.append((int(x,16)<<4)+int(y,16))
-	return b
+	if len(s) & 1:
+		s = s[:-1]	# A trailing half byte was always dropped
+	return bytearray.fromhex(s)
 
 def b2h(s):
 	return s.hex()
 	# return ''.join(['%02x'%ord(x) for x in s])
 
 def h2i(s):
-	return [(int(x,16)<<4)+int(y,16) for x,y in zip(s[0::2], s[1::2])]
+	return list(h2b(s))
 
 def i2h(s):
-	return ''.join(['%02x'%(x) for x in s])
+	return bytes(s).hex()
 
 def swap_nibbles(s):
 	return ''.join([x+y for x,y in zip(s[1::2], s[0::2])])
@@ -179,121 +178,115 @@ def GSMPhoneNumberToString(phoneString, replaceTonNPI=0):
 
 # ===============================================================================
 
-# GSM3.38 character conversion table
-dic_GSM_3_38 = {'@': 0x00,  # @ At symbol
-				chr(0x9C): 0x01,  # £ Britain pound symbol
-				'$': 0x02,  # $ Dollar symbol
-				chr(0xA5): 0x03,  # ¥ Yen symbol
-				'è': 0x04,  # è e accent grave
-				'é': 0x05,  # é e accent aigu
-				'ù': 0x06,  # ù u accent grave
-				chr(0xEC): 0x07,  # ì i accent grave
-				chr(0xF2): 0x08,  # ò o accent grave
-				chr(0xC7): 0x09,  # Ç C majuscule cedille
-				chr(0x0A): 0x0A,  # LF Line Feed
-				chr(0xD8): 0x0B,  # Ø O majuscule barré
-				chr(0xF8): 0x0C,  # ø o minuscule barré
-				chr(0x0D): 0x0D,  # CR Carriage Return
-				chr(0xC5): 0x0E,  # Å Angstroem majuscule
-				chr(0xE5): 0x0F,  # å Angstroem minuscule
+# GSM 03.38 default alphabet, indexed by septet value. 0x1B is the escape to
+# the extension table, shown as a space when nothing follows it.
+GSM_3_38_ALPHABET = ('@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ ÆæßÉ'
+					 ' !"#¤%&\'()*+,-./0123456789:;<=>?'
+					 '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§'
+					 '¿abcdefghijklmnopqrstuvwxyzäöñüà')
 
-				'_': 0x11,  # underscore
-				chr(0xC6): 0x1C,  # Æ majuscule ae
-				chr(0xE6): 0x1D,  # æ minuscule ae
-				chr(0xDF): 0x1E,  # ß s dur allemand
-				chr(0xC9): 0x1F,  # É majuscule é
+# GSM 03.38 extension table, septets following an escape (0x1B)
+GSM_3_38_EXTENSION = {0x0A: '\x0c', 0x14: '^', 0x28: '{', 0x29: '}', 0x2F: '\\',
+					  0x3C: '[', 0x3D: '~', 0x3E: ']', 0x40: '|', 0x65: '€'}
 
-				' ': 0x20, '!': 0x21,
-				'\"': 0x22,  # guillemet
-				'#': 0x23,
-				'¤': 0x24,  # ¤ carré
+# str.translate table of the default alphabet, applied to septets decoded
+# as latin-1
+_GSM_3_38_DECODE = dict(enumerate(GSM_3_38_ALPHABET))
 
-				chr(0xA1): 0x40,  # ¡ point d'exclamation renversé
 
-				chr(0xC4): 0x5B,  # Ä majuscule A trema
-				chr(0xE4): 0x7B,  # ä minuscule a trema
+class _GSMEncodeTable(dict):
+	# Characters out of the GSM 03.38 alphabets are sent as '?'
+	def __missing__(self, key):
+		return '?'
 
-				chr(0xD6): 0x5C,  # Ö majuscule O trema
-				chr(0xF6): 0x7C,  # ö minuscule o trema
 
-				chr(0xD1): 0x5D,  # Ñ majuscule N tilda espagnol
-				chr(0xF1): 0x7D,  # ñ minuscule n tilda espagnol
+# str.translate table giving the septets of each character, as latin-1, the
+# ones of the extension table being escaped. The space of the escape (0x1B)
+# is overridden by the real one.
+_GSM_3_38_ENCODE = _GSMEncodeTable((ord(c), chr(i)) for i, c in enumerate(GSM_3_38_ALPHABET))
+_GSM_3_38_ENCODE.update((ord(c), '\x1b' + chr(i)) for i, c in GSM_3_38_EXTENSION.items())
 
-				chr(0xDC): 0x5E,  # Ü majuscule U trema
-				chr(0xFC): 0x7E,  # ü minuscule u trema
+_SEPTET_SHIFTS = tuple(range(0, 56, 7))
 
-				chr(0xA7): 0x5F,  # § signe paragraphe
 
-				chr(0xBF): 0x60,  # ¿ point interrogation renversé
+def unpack_septets(data, count=None):
+	""" unpacks GSM 7-bit packed data (TS 23.038 section 6.1.2.1), 7 bytes
+        giving 8 septets at a time
+        Input :
+            - data     = bytes of the packed data
+            - count    = number of septets (default: as many as fit)
 
-				'à': 0x7F  # a accent grave
-				}
+        Return bytes of the septet values.
+    """
+	if count is None:
+		count = len(data) * 8 // 7
+	fb = int.from_bytes
+	groups = [fb(data[i:i + 7], 'little') for i in range(0, len(data), 7)]
+	return bytes([(v >> s) & 0x7f for v in groups for s in _SEPTET_SHIFTS][:count])
 
 
-def ASCIIToGSM3_38(sName):
-	""" converts an ascii name string to a GSM 3.38 name string
-        sample : "@£$èéùPascal" is converted to "\x00\x01\x02\x04\x05\x06"
+def pack_septets(septets):
+	""" packs septets into GSM 7-bit data (TS 23.038 section 6.1.2.1), 8
+        septets giving 7 bytes at a time
         Input :
-            - sName     = string containing the name
-        Returns a string
+            - septets  = bytes of septet values
+
+        Return bytes of the packed data.
     """
+	res = []
+	for i in range(0, len(septets), 8):
+		group = septets[i:i + 8]
+		v = sum([c << s for c, s in zip(group, _SEPTET_SHIFTS)])
+		res.append(v.to_bytes((len(group) * 7 + 7) // 8, 'little'))
+	return b''.join(res)
+
+
+def encode_gsm_3_38(text):
+	""" converts text to septets of the GSM 03.38 default alphabet, escapes
+        to the extension table included, characters of neither as '?'
+        sample : "Hi€" is converted to b"\x48\x69\x1b\x65"
+        Input :
+            - text     = string
 
-	gsmName = ''
-	for char in sName:
-		if ((char >= "%") and (char <= "?")):
-			gsmName += char
-		elif ((char >= "A") and (char <= "Z")):
-			gsmName += char
-		elif ((char >= "a") and (char <= "z")):
-			gsmName += char
-		else:
-			gsmName += chr(dic_GSM_3_38[char])
-	return gsmName
+        Return bytes of septet values.
+    """
+	return text.translate(_GSM_3_38_ENCODE).encode('latin-1')
 
 
-# ===============================================================================
+def decode_gsm_3_38(septets):
+	""" converts septets of the GSM 03.38 default alphabet to text, escapes
+        to the extension table included
+        sample : b"\x48\x69\x1b\x65" is converted to "Hi€"
+        Input :
+            - septets  = bytes of septet values
 
-dic_GSM_3_38_toAscii = {0x00: '@',  # @ At symbol
-						0x01: '£',  # £ Britain pound symbol
-						0x02: '$',  # $ Dollar symbol
-						0x03: chr(0xA5),  # ¥ Yen symbol
-						0x04: 'è',  # è e accent grave
-						0x05: 'é',  # é e accent aigu
-						0x06: 'ù',  # ù u accent grave
-						0x07: chr(0xEC),  # ì i accent grave
-						0x08: chr(0xF2),  # ò o accent grave
-						0x09: chr(0xC7),  # Ç C majuscule cedille
-						0x0A: chr(0x0A),  # LF Line Feed
-						0x0B: chr(0xD8),  # Ø O majuscule barré
-						0x0C: chr(0xF8),  # ø o minuscule barré
-						0x0D: chr(0x0D),  # CR Carriage Return
-						0x0E: chr(0xC5),  # Å Angstroem majuscule
-						0x0F: chr(0xE5),  # å Angstroem minuscule
-						0x11: '_',  # underscore
-						0x1C: chr(0xC6),  # Æ majuscule ae
-						0x1D: chr(0xE6),  # æ minuscule ae
-						0x1E: chr(0xDF),  # ß s dur allemand
-						0x1F: chr(0xC9),  # É majuscule é
-
-						0x20: ' ',
-						0x21: '!',
-						0x22: '\"',  # guillemet
-						0x23: '#',
-						0x24: '¤',  # ¤ carré
-
-						0x40: chr(0xA1),  # ¡ point d'exclamation renversé
-						0x5B: chr(0xC4),  # Ä majuscule A trema
-						0x5C: chr(0xD6),  # Ö majuscule O trema
-						0x5D: chr(0xD1),  # Ñ majuscule N tilda espagnol
-						0x5E: chr(0xDC),  # Ü majuscule U trema
-						0x5F: chr(0xA7),  # § signe paragraphe
-						0x60: chr(0xBF),  # ¿ point interrogation renversé
-						0x7B: chr(0xE4),  # ä minuscule a trema
-						0x7C: chr(0xF6),  # ö minuscule o trema
-						0x7D: chr(0xF1),  # ñ minuscule n tilda espagnol
-						0x7E: chr(0xFC),  # ü minuscule u trema
-						0x7F: 'à'  # a accent grave
-						}
+        Return a string.
+    """
+	septets = bytes(septets)
+	if b'\x1b' not in septets:
+		return septets.decode('latin-1').translate(_GSM_3_38_DECODE)
+
+	parts = septets.split(b'\x1b')
+	res = [parts[0].decode('latin-1').translate(_GSM_3_38_DECODE)]
+	for part in parts[1:]:
+		if not part:
+			res.append(' ')
+			continue
+		# Unknown extensions are shown as the default character
+		c = part[0]
+		res.append(GSM_3_38_EXTENSION.get(c) or chr(c).translate(_GSM_3_38_DECODE))
+		res.append(part[1:].decode('latin-1').translate(_GSM_3_38_DECODE))
+	return ''.join(res)
+
+
+def ASCIIToGSM3_38(sName):
+	""" converts an ascii name string to a GSM 3.38 name string
+        sample : "@£$èéùPascal" is converted to "\x00\x01\x02\x04\x05\x06Pascal"
+        Input :
+            - sName     = string containing the name
+        Returns a string
+    """
+	return sName.translate(_GSM_3_38_ENCODE)
 
 
 def GSM3_38ToASCII(gsmName):
@@ -305,17 +298,43 @@ def GSM3_38ToASCII(gsmName):
         sample : "\x00\x01\x02\x04\x05\x06Pascal"
                  is converted to "@£$èéùPascal"
     """
+	# End of name reached, treat an NULL character
+	gsmName = gsmName.split('\xff', 1)[0]
+	return decode_gsm_3_38(gsmName.encode('latin-1'))
+
+
+# ===============================================================================
+
+def decode_adn(record):
+	""" decodes an EF_ADN record (TS 11.11 section 10.5.1)
+        sample : "4a6f686effffffffffffffffffff059110325476ffffffffffffffff"
+                 is decoded to ("John", "+01234567")
+        Input :
+            - record   = hex string of the record
+
+        Return a tuple (name, number), None for an empty record.
+    """
+	alpha_len = len(record) // 2 - 14
+	if alpha_len < 0:
+		return None
+	alpha = h2b(record[:alpha_len * 2])
+	num = record[alpha_len * 2:]
+	num_len = int(num[:2], 16)
+
+	if alpha[:1] == b'\x80':  # UCS2
+		name = bytes(alpha[1:]).split(b'\xff\xff')[0]
+		name = name[:len(name) & ~1].decode('utf-16-be', 'replace')
+	else:
+		name = GSM3_38ToASCII(alpha.decode('latin-1'))
+
+	if num_len == 0xff or num_len < 2:
+		number = ''
+	else:
+		number = GSMPhoneNumberToString(num[2:2 + num_len * 2], replaceTonNPI=1).rstrip('fF')
 
-	sName = ""
-	for i in gsmName:
-		c = ord(i)
-		if c == 0xFF:  # End of name reached, treat an NULL character
-			break
-		elif c in dic_GSM_3_38_toAscii:
-			sName += dic_GSM_3_38_toAscii[c]
-		else:
-			sName += i
-	return sName
+	if not name and not number:
+		return None
+	return name, number
 
 
 # ===============================================================================